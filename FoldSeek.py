@@ -14,6 +14,9 @@ MainMenu: Analyze
       Request: foldseek
 """
 
+# used as a decorator below, so imported before the functions unlike the other modules
+from contextlib import closing, contextmanager
+
 ### custom functions
 def check_and_install_module(module_name):
     try:
@@ -28,12 +31,125 @@ def stop_plg(message, fs=True, start_time=None):
         start_time = time.perf_counter()
     PrintCon()
     if fs:
+        if cache_stats['hits'] + cache_stats['misses']:
+            Print(f"Structure cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({CACHE_DIR}), {cache_stats['mirror']} from local mirror")
         Print(f'Ran FoldSeek plugin on object {selection[0].objects} searching the {databases[int(db) -1]} database for the {n_get} closest structural homologs.\nTime for execution of script: {timedelta(seconds=float("{:.1f}".format(time.perf_counter() - start_time)))}')
     ShowMessage(message)
     Wait('Continuebutton')
     HideMessage()
     plugin.end()
 
+def query_names(targets):
+    # names of the query files, alignments and hit folders of the target objects. YASARA allows several objects
+    # with the same name, those get their object number appended so they don't overwrite each other's queries
+    names = [NameObj(target)[0] for target in targets]
+    unique = []
+    for name, target in zip(names, targets):
+        if names.count(name) > 1:
+            name = f'{name}_{target}'
+        while name in unique:
+            name = f'{name}_{target}'
+        if name != names[len(unique)]:
+            print(f'Another object is also named {names[len(unique)]}, the output of object {target} is named {name}.')
+        unique.append(name)
+    return unique
+
+
+def discover_foldseek():
+    # foldseek executable by trying `which`, then checking the conda bin dir, then searching everywhere.
+    # the path, its version and the databases in DB_DIR are kept in DISCOVERY_FILE, so the filesystem search
+    # and `foldseek -h` only run again when the binary or DB_DIR changed (mtime) or after DISCOVERY_TTL_DAYS.
+    # major is the release number of the version (see major_version)
+    try:
+        with open(DISCOVERY_FILE) as file:
+            found = json.load(file)
+    except (OSError, ValueError):
+        found = {}
+    fs = shutil.which('foldseek')
+    conda_fs = os.path.join(os.path.dirname(os.environ.get('CONDA_EXE', '')), 'foldseek')
+    if not fs and os.environ.get('CONDA_EXE') and os.path.exists(conda_fs):
+        fs = conda_fs
+    if not fs and found.get('path') and os.path.exists(found['path']):
+        fs = found['path']
+    if not fs and time.time() - found.get('searched', 0) > DISCOVERY_TTL_DAYS * 86400:
+        fs = find_subfolder('foldseek', 'bin', '/')
+        if fs:
+            fs = fs + '/bin/foldseek'
+        found['searched'] = time.time()
+
+    if not fs:
+        found.update(path=None, mtime=None, version=None)
+    elif fs != found.get('path') or os.path.getmtime(fs) != found.get('mtime'):
+        version = re.search('(?<=Version: ).*', subprocess.run(f'{fs} -h', shell=True, capture_output=True, text=True).stdout)
+        found.update(path=fs, mtime=os.path.getmtime(fs), version=version.group() if version else None)
+    found['major'] = major_version(found['version'])
+
+    db_mtime = os.path.getmtime(DB_DIR) if os.path.isdir(DB_DIR) else None
+    if found.get('db_dir') != DB_DIR or found.get('db_mtime') != db_mtime:
+        found.update(db_dir=DB_DIR, db_mtime=db_mtime, dbs=find_dbs(DB_DIR))
+
+    tmp = cache_temp(DISCOVERY_FILE)
+    with open(tmp, 'w') as file:
+        json.dump(found, file)
+    os.replace(tmp, DISCOVERY_FILE)
+    return found
+
+
+def major_version(version):
+    # 10 for release 10.941cd33; builds from git report a commit hash instead, they are newer than any release
+    if not version:
+        return None
+    major = version.split('.')[0]
+    return int(major) if major.isdigit() else math.inf
+
+
+def add_time(name, seconds):
+    with _stats_lock:
+        run_stats['phases'][name] = run_stats['phases'].get(name, 0) + seconds
+
+
+@contextmanager
+def phase(name):
+    # add the wall time of the block to run_stats; background phases overlap, so their sum can exceed the total
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def write_report(report_file, start_time, **info):
+    # the run's phase times, downloads and cache use as JSON, for comparing runs, and a short summary in the console.
+    # bytes and latency are those of network fetches, files from the cache or a mirror are only counted by source
+    downloads = sorted([x for x in run_stats['downloads'] if x['source'] == 'network'], key=lambda x: x['seconds'])
+    sources = {}
+    for x in run_stats['downloads']:
+        sources[x['source']] = sources.get(x['source'], 0) + 1
+    fetched = cache_stats['hits'] + cache_stats['misses']
+    report = dict(info, created=time.time(), total_seconds=round(time.perf_counter() - start_time, 3),
+                  phases={name: round(seconds, 3) for name, seconds in sorted(run_stats['phases'].items(), key=lambda x: -x[1])},
+                  downloads={'count': len(downloads), 'failed': sum(not x['ok'] for x in run_stats['downloads']), 'sources': sources,
+                             'bytes': sum(x['bytes'] for x in downloads),
+                             'mean_seconds': round(sum(x['seconds'] for x in downloads) / len(downloads), 4) if downloads else None,
+                             'p95_seconds': downloads[math.ceil(0.95 * (len(downloads) - 1))]['seconds'] if downloads else None,
+                             'files': run_stats['downloads']},
+                  structure_cache=dict(cache_stats, hit_rate=round(cache_stats['hits'] / fetched, 3) if fetched else None),
+                  search_cache_hits=run_stats['search_cache'])
+    tmp = cache_temp(report_file)
+    with open(tmp, 'w') as file:
+        json.dump(report, file, indent=1)
+    os.replace(tmp, report_file)
+
+    print(f"Run report {report_file}: {report['total_seconds']:.1f}s in total")
+    for name, seconds in report['phases'].items():
+        print(f'  {name.ljust(16)}{seconds:8.1f}s')
+    if downloads:
+        print(f"  {len(downloads)} files, {report['downloads']['bytes'] / 1e6:.1f} MB, {report['downloads']['failed']} failed, "
+              f"latency mean {report['downloads']['mean_seconds']:.2f}s / p95 {report['downloads']['p95_seconds']:.2f}s")
+    if len(downloads) < len(run_stats['downloads']):
+        print(f"  {sources.get('cache', 0)} files from the cache, {sources.get('mirror', 0)} from the mirror")
+
+
 def find_subfolder(target_folder_name, parent_folder_name, start_directory):
     for dirpath, dirnames, filenames in os.walk(start_directory):
         if parent_folder_name in dirnames:
@@ -44,102 +160,1392 @@ def find_subfolder(target_folder_name, parent_folder_name, start_directory):
     return None
 
 
-def convert_cif_to_pdb(cif_file_path, pdb_file_path):
-    # Create a CIF parser and parse the CIF file
-    cif_parser = MMCIFParser()
-    structure = cif_parser.get_structure("structure", cif_file_path)
-
-    # Create a PDBIO object to write the PDB file
-    pdb_io = PDBIO()
-
-    # Save the structure as a PDB file
-    pdb_io.set_structure(structure)
-    pdb_io.save(pdb_file_path)
-
+def convert_cif_to_pdb(cif_file_path, pdb_file_path, chain=None):
+    # stream the _atom_site loop into PDB records, keeping only the first model and, if given, one chain.
+    # written next to the pdb and renamed when complete, so a failed conversion leaves no partial file.
+    # like trim_pdb, the whole first model is kept if the chain is missing
+    tmp = cache_temp(pdb_file_path)
+    try:
+        if not write_cif_as_pdb(cif_file_path, tmp, chain):
+            print(f'Chain {chain} not found in {cif_file_path}, keeping all chains.')
+            write_cif_as_pdb(cif_file_path, tmp)
+        os.replace(tmp, pdb_file_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_cif_as_pdb(cif_file_path, pdb_file_path, chain=None):
+    # False if the chain has no atoms in the first model
+    fields = {}
+    columns = None
+    tokens = []
+    model = None
+    last_chain = None
+    long_chains = set()
+    serial = 0
+    with open(cif_file_path) as cif_file, open(pdb_file_path, 'w') as pdb_file:
+        for line in cif_file:
+            if line.startswith('_atom_site.'):
+                fields[line.split()[0][11:]] = len(fields)
+                continue
+            if not fields:
+                continue
+            if line.startswith(('#', 'loop_', '_', 'data_')):
+                break
+            tokens += _cif_token.findall(line)
+            if len(tokens) < len(fields):
+                continue
+            if columns is None:
+                columns = {key: next((fields[x] for x in names if x in fields), None) for key, names in _cif_columns.items()}
+            atom = {key: cif_value(tokens[i]) if i is not None else '' for key, i in columns.items()}
+            tokens = []
+
+            if model is None:
+                model = atom['model']
+            if atom['model'] != model or (chain is not None and atom['chain'] != chain):
+                continue
+            if last_chain is not None and atom['chain'] != last_chain:
+                pdb_file.write('TER\n')
+            last_chain = atom['chain']
+            if len(atom['chain']) > 1:
+                long_chains.add(atom['chain'])
+
+            serial = serial % 99999 + 1
+            name = atom['name']
+            if len(name) < 4 and len(atom['element']) == 1:
+                name = ' ' + name
+            charge = atom['charge']
+            if charge in ('', '0'):
+                charge = ''
+            else:
+                charge = charge.lstrip('+-') + ('-' if charge.startswith('-') else '+')
+            pdb_file.write(f"{atom['group']:<6}{serial:>5} {name:<4}{atom['alt']:1}{atom['resn'][:3]:>3} {atom['chain'][:1]:1}"
+                           f"{atom['resi']:>4}{atom['icode']:1}   {float(atom['x']):8.3f}{float(atom['y']):8.3f}{float(atom['z']):8.3f}"
+                           f"{float(atom['occ'] or 1):6.2f}{float(atom['b'] or 0):6.2f}          {atom['element']:>2}{charge:2}\n")
+        if last_chain is None:
+            if chain is not None:
+                return False
+            raise ValueError(f'no atoms found in {cif_file_path}')
+        pdb_file.write('TER\nEND\n')
+    # the pdb format has one character for the chain, so AA and A end up in the same chain
+    if long_chains:
+        print(f'Warning: chains {", ".join(sorted(long_chains))} of {cif_file_path} are cut to their first character in PDB format.')
+    return True
+
+
+def cif_value(token):
+    if token in ('?', '.'):
+        return ''
+    if token[0] in '\'"':
+        return token[1:-1]
+    return token
+
+
+def get_session(url):
+    # one keep-alive session per host (RCSB, AlphaFold EBI, ESM Atlas), shared by all download workers
+    # requests is imported here, so the button handlers that don't download start without it
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        if host not in _sessions:
+            retries = Retry(total=DL_RETRIES, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+            # the AlphaFold DB API shares its host with the structure files, so there's room for both
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=DL_WORKERS + ANNOTATION_WORKERS, max_retries=retries)
+            session = Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+        return _sessions[host]
+
+
+def cache_db(server):
+    # name under which entries of a download server are kept in the structure cache
+    return {RCSB_SERVER: 'pdb', AFDB_SERVER: 'afdb', ESM_SERVER: 'esm'}.get(server, urlsplit(server).netloc.replace(':', '_'))
+
+
+def cache_path(dbname, id, ext):
+    key = hashlib.sha1(f'{dbname}/{id}'.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, 'structures', dbname, key[:2], key + ext)
+
+
+def cache_lookup(dbname, id):
+    # return the cached file of an entry (pdb or cif) and mark it as recently used
+    for ext in ['.pdb', '.cif']:
+        path = cache_path(dbname, id, ext)
+        try:
+            os.utime(path)
+            return path
+        except OSError:
+            pass
+    return None
 
-def get_pdbs(pdb_ids, dlserver, dir, target):
-    # for pdb: download with rsync if more than 20, otherwise and non-rsynced manually
-    if dlserver == 'https://files.rcsb.org/view' and len(pdb_ids) > 20:
-        with open(os.path.join(dir, f'{target}_hits_rslist'), 'w') as file:
-            for i in range(len(pdb_ids)):
-                file.write(f"pdb{pdb_ids[i]}.ent.gz\n")   
 
-        noerr = subprocess.run(f'rsync -rlptL -v -z --delete --relative --files-from={os.path.join(dir, f"{target}_hits_rslist")} --port=33444 rsync.wwpdb.org::ftp/data/structures/all/pdb/ {outputdir}/hits/', 
-                shell=True, capture_output=True, text=True)
-        for line in noerr.stdout.split('\n'):
-            print(line)
-        
-        for i in range(len(pdb_ids)):
-            if os.path.exists(f'{dir}/pdb{pdb_ids[i]}.ent.gz'):
-                print(f'file {pdb_ids[i]} was rsynced, extracting.')
-                with gzip.open(f'{dir}/pdb{pdb_ids[i]}.ent.gz', 'rb') as input_file:
-                    with open(f'{dir}/{i+1}_{pdb_ids[i]}.pdb', 'wb') as output_file:
-                        output_file.write(input_file.read())
-                os.remove(f'{dir}/pdb{pdb_ids[i]}.ent.gz')
-            else:
-                print(f'file {pdb_ids[i]} wasn\'t rsynced, getting it manually.')
-                download_pdb(dlserver, pdb_ids[i], f'{dir}/{i+1}_{pdb_ids[i]}.pdb')
+def cache_temp(dst):
+    # unique name next to dst, so concurrent writers never see each others partial files
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    return f'{dst}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def cache_evict():
+    # drop least recently used entries until the cache is below its size cap again
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(CACHE_DIR, 'structures')):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(x[1] for x in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= CACHE_MAX_MB * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def query_hash(pdb_file, *options):
+    # hash of the query atoms and coordinates only, so headers and save dates don't matter, plus the search options
+    sha = hashlib.sha256()
+    with open(pdb_file, 'rb') as file:
+        for line in file:
+            if line.startswith((b'ATOM', b'HETATM')):
+                sha.update(line[12:27] + line[30:54])
+    for option in options:
+        sha.update(b'\0' + str(option).encode())
+    return sha.hexdigest()
+
+
+def search_cache_get(key):
+    # metadata of a stored search result, if it has not expired
+    meta_file = os.path.join(CACHE_DIR, 'searches', key, 'meta.json')
+    try:
+        with open(meta_file) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if time.time() - meta['created'] > SEARCH_TTL_DAYS * 86400:
+        return None
+    meta['aln'] = os.path.join(CACHE_DIR, 'searches', key, 'aln')
+    run_stats['search_cache'] += 1
+    return meta
+
+
+def search_cache_put(key, aln_file, **meta):
+    # alignment files are copied, not linked, as foldseek overwrites its output files in place
+    dir = os.path.join(CACHE_DIR, 'searches', key)
+    tmp = cache_temp(os.path.join(dir, 'aln'))
+    shutil.copyfile(aln_file, tmp)
+    os.replace(tmp, os.path.join(dir, 'aln'))
+    tmp = cache_temp(os.path.join(dir, 'meta.json'))
+    with open(tmp, 'w') as file:
+        json.dump(dict(meta, created=time.time()), file)
+    os.replace(tmp, os.path.join(dir, 'meta.json'))
+    search_cache_evict()
+
+
+def search_cache_evict():
+    # drop expired results, then the oldest ones beyond SEARCH_CACHE_MAX
+    root = os.path.join(CACHE_DIR, 'searches')
+    entries = []
+    for key in os.listdir(root):
+        try:
+            entries.append((os.path.getmtime(os.path.join(root, key, 'meta.json')), key))
+        except OSError:
+            continue
+    entries.sort(reverse=True)
+    for n, (mtime, key) in enumerate(entries):
+        if n >= SEARCH_CACHE_MAX or time.time() - mtime > SEARCH_TTL_DAYS * 86400:
+            shutil.rmtree(os.path.join(root, key), ignore_errors=True)
+
+
+def link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def mirror_signature(root):
+    # adding or removing files changes the mtime of their shard directory
+    stamps = [os.stat(root).st_mtime] + [x.stat().st_mtime for x in os.scandir(root) if x.is_dir()]
+    return f'{len(stamps)} {max(stamps)}'
+
+
+def mirror_index(root):
+    # accession -> file path of all entries in a local mirror, persisted next to the structure cache
+    with _mirror_lock:
+        if root in _mirror_indexes:
+            return _mirror_indexes[root]
+        signature = mirror_signature(root)
+        index_file = os.path.join(CACHE_DIR, 'mirrors', hashlib.sha1(root.encode()).hexdigest() + '.tsv.gz')
+        index = {}
+        if os.path.exists(index_file):
+            with gzip.open(index_file, 'rt') as file:
+                if file.readline().rstrip('\n') == signature:
+                    index = dict(line.rstrip('\n').split('\t') for line in file)
+        if not index:
+            print(f'Indexing structure mirror {root}')
+            for dirpath, dirnames, filenames in os.walk(root):
+                for filename in filenames:
+                    match = _mirror_file.match(filename)
+                    if match:
+                        index[match.group(1)] = os.path.relpath(os.path.join(dirpath, filename), root)
+            tmp = cache_temp(index_file)
+            with gzip.open(tmp, 'wt') as file:
+                file.write(signature + '\n')
+                file.writelines(f'{acc}\t{path}\n' for acc, path in index.items())
+            os.replace(tmp, index_file)
+            print(f'Found {len(index)} entries in {root}')
+        _mirror_indexes[root] = index
+        return index
+
+
+def mirror_lookup(server, id):
+    root = {RCSB_SERVER: PDB_MIRROR, AFDB_SERVER: AFDB_MIRROR}.get(server)
+    if not root or not os.path.isdir(root):
+        return None
+    index = mirror_index(root)
+    path = index.get(id) or index.get(id.lower())
+    return os.path.join(root, path) if path else None
+
+
+def db_files(fsdb):
+    # all files of a foldseek database: the data itself, .index, .dbtype, _ss, _ca, _h, .lookup, .idx ...
+    folder, name = os.path.split(fsdb)
+    return [os.path.join(folder, file) for file in os.listdir(folder)
+            if file == name or file.startswith(name + '.') or file.startswith(name + '_')]
+
+
+def find_dbs(db_dir):
+    # databases are the .dbtype files that are no component (name_ss, name.idx ...) of another one
+    if not os.path.isdir(db_dir):
+        return []
+    names = [file[:-len('.dbtype')] for file in os.listdir(db_dir) if file.endswith('.dbtype')]
+    return sorted(name for name in names
+                  if not any(name.startswith(other + '_') or name.startswith(other + '.') for other in names))
+
+
+def db_size(fsdb, index=False):
+    # bytes of the database (index=False) or of its createindex index (index=True)
+    idx = os.path.basename(fsdb) + '.idx'
+    return sum(os.path.getsize(file) for file in db_files(fsdb)
+               if os.path.basename(file).startswith(idx) == index)
+
+
+def index_valid(fsdb):
+    # an index is usable if it is complete and not older than any file of the database
+    idx = fsdb + '.idx'
+    if not all(os.path.exists(idx + ext) and os.path.getsize(idx + ext) > 0 for ext in ('', '.index', '.dbtype')):
+        return False
+    db_mtime = max(os.path.getmtime(file) for file in db_files(fsdb)
+                   if not os.path.basename(file).startswith(os.path.basename(idx)))
+    return os.path.getmtime(idx) >= db_mtime and os.path.getmtime(idx + '.index') >= db_mtime
+
+
+def build_index(fs, fsdb):
+    # foldseek createindex writes <fsdb>.idx next to the database; returns whether it succeeded
+    tmp_dir = os.path.join(gettempdir(), 'fs_plg_createindex')
+    fs_command = f'{fs} createindex {fsdb} {tmp_dir} --remove-tmp-files true'
+    print('Command:\n' + fs_command)
+    noerr = subprocess.run(fs_command, shell=True, capture_output=True, text=True)
+    for line in noerr.stdout.split('\n'):
+        print(line)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    return noerr.returncode == 0 and index_valid(fsdb)
+
+
+def gunzip_file(src, dst):
+    # decompress in chunks, the whole entry is never held in memory
+    tmp = cache_temp(dst)
+    with gzip.open(src, 'rb') as input_file:
+        with open(tmp, 'wb') as output_file:
+            shutil.copyfileobj(input_file, output_file, DL_CHUNK)
+    os.replace(tmp, dst)
+
+
+def get_pdbs(pdb_ids, dlserver, dir, target, chains=None, ready=None, manifest=None):
+    # dlserver is one server for all ids or a list with the server of each id (hits of several databases).
+    # with a manifest (see open_manifest) the files an earlier run already got are kept and every step is recorded in it.
+    # look up everything in the structure cache and the local mirror first, only fetch what is missing
+    servers = dlserver if isinstance(dlserver, list) else [dlserver] * len(pdb_ids)
+    jobs = [(servers[i], pdb_ids[i], f'{dir}/{i+1}_{pdb_ids[i]}.pdb', chains[i] if chains else None) for i in range(len(pdb_ids))]
+    todo = range(len(jobs))
+    if manifest is not None:
+        todo = [i for i in todo if 'downloaded' not in manifest['hits'][i]['done'] or not os.path.exists(jobs[i][2])]
+        if ready is not None:
+            for i in set(range(len(jobs))) - set(todo):
+                ready.put(i)
+        if len(todo) < len(jobs):
+            print(f'{len(jobs) - len(todo)} of {len(jobs)} structures are left from the earlier run')
+    missing = [i for i in todo if cache_lookup(cache_db(servers[i]), pdb_ids[i]) is None]
+    cache_stats['hits'] += len(todo) - len(missing)
+    cache_stats['misses'] += len(missing)
+    mirrored = [i for i in missing if mirror_lookup(servers[i], pdb_ids[i])]
+    cache_stats['mirror'] += len(mirrored)
+    missing = [i for i in missing if i not in mirrored]
+
+    # for pdb: download with rsync if more than RSYNC_MIN, otherwise and non-rsynced manually.
+    # rsync runs next to the other downloads and each entry joins them as soon as it is in the cache
+    missing_pdb = [i for i in missing if servers[i] == RCSB_SERVER]
+    rsyncing = None
+    if len(missing_pdb) > RSYNC_MIN:
+        rsyncing = queue.Queue()
+        threading.Thread(target=rsync_jobs, args=({i: jobs[i] for i in missing_pdb}, dir, target, rsyncing), daemon=True).start()
     else:
-        for i in range(n_get):
-            download_pdb(dlserver, pdb_ids[i], f'{dir}/{i+1}_{pdb_ids[i]}.pdb')
-
+        missing_pdb = []
+
+    with phase('download'):
+        failed = download_pdbs({i: jobs[i] for i in todo if i not in missing_pdb}, ready, manifest, more=rsyncing)
+        # a missing or broken entry stays that way, only downloads that broke off are tried again
+        for attempt in range(1, DL_ATTEMPTS):
+            retry = {i: jobs[i] for i, error in failed.items() if error not in ('not found', 'not convertible')}
+            if not retry:
+                break
+            print(f'Retrying {len(retry)} failed downloads in {DL_RETRY_WAIT * attempt}s ({attempt + 1} of {DL_ATTEMPTS} attempts)')
+            time.sleep(DL_RETRY_WAIT * attempt)
+            failed = {i: error for i, error in failed.items() if i not in retry}
+            failed.update(download_pdbs(retry, ready, manifest))
+    cache_evict()
+    return [pdb_ids[i] for i in failed]
+
+
+def start_pdbs(pdb_ids, dlserver, dir, target, chains=None, manifest=None):
+    # run get_pdbs in the background; the queue yields hit indices as their files land, then None
+    ready = queue.Queue()
+
+    def produce():
+        try:
+            get_pdbs(pdb_ids, dlserver, dir, target, chains=chains, ready=ready, manifest=manifest)
+        finally:
+            ready.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    return ready
+
+
+def rsync_jobs(jobs, dir, target, more):
+    # rsync the entries of the download jobs (see get_pdbs) and put each job on the queue more once its entry is
+    # in the cache, then the jobs of entries rsync didn't deliver, which are downloaded manually, and finally None
+    by_id = {}
+    for i, job in jobs.items():
+        by_id.setdefault(job[1], []).append(i)
+    sent = set()
+    lock = threading.Lock()
+
+    def landed(id):
+        with lock:
+            for i in by_id.get(id, []):
+                if i not in sent:
+                    sent.add(i)
+                    more.put((i, jobs[i]))
 
-def download_pdb(server, id, outfile):
+    try:
+        with phase('rsync'):
+            rsync_pdbs(sorted(by_id), dir, target, landed)
+    finally:
+        with lock:
+            for i, job in jobs.items():
+                if i not in sent:
+                    print(f'file {job[1]} wasn\'t rsynced, getting it manually.')
+                    more.put((i, job))
+            more.put(None)
+
+
+def rsync_pdbs(pdb_ids, dir, target, landed=None):
+    # tail rsync -v and extract every file into the structure cache as soon as it has arrived, while the transfer continues.
+    # landed is called with the id of each extracted entry
+    with open(os.path.join(dir, f'{target}_hits_rslist'), 'w') as file:
+        for id in pdb_ids:
+            file.write(f"pdb{id}.ent.gz\n")
+
+    rsync_command = ['rsync', '-rlptL', '-v', '-z', '--outbuf=L', '--relative', f'--files-from={os.path.join(dir, f"{target}_hits_rslist")}',
+                     '--port=33444', RSYNC_SOURCE, dir]
+    try:
+        proc = subprocess.Popen(rsync_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except OSError as e:
+        print(f'Could not run rsync: {e}')
+        return set()
+
+    rsynced = set()
+    with ThreadPoolExecutor(max_workers=DL_WORKERS) as pool:
+        futures = {}
+        for line in proc.stdout:
+            line = line.strip()
+            print(line)
+            match = re.match(r'^pdb(.+)\.ent\.gz$', line)
+            if match and match.group(1) in pdb_ids and match.group(1) not in futures:
+                futures[match.group(1)] = pool.submit(extract_rsynced, os.path.join(dir, line), match.group(1), proc, landed)
+        proc.wait()
+        for id, future in futures.items():
+            try:
+                if future.result():
+                    rsynced.add(id)
+            except OSError as e:
+                print(f'Failed to extract {id}: {e}')
+    return rsynced
+
+
+def extract_rsynced(gz_file, id, proc, landed=None):
+    # rsync names a file when it starts on it and renames it into place once complete
+    while not os.path.exists(gz_file):
+        if proc.poll() is not None:
+            if not os.path.exists(gz_file):
+                return False
+            break
+        time.sleep(0.05)
+    print(f'file {id} was rsynced, extracting.')
+    gunzip_file(gz_file, cache_path(cache_db(RCSB_SERVER), id, '.pdb'))
+    os.remove(gz_file)
+    if landed:
+        landed(id)
+    return True
+
+
+def download_pdbs(jobs, ready=None, manifest=None, more=None):
+    # jobs map hit indices to (server, id, outfile, chain) tuples; they run concurrently and are reported as they finish.
+    # more is an optional queue of (index, job) pairs that join while the others run, ended by None (see rsync_jobs).
+    # with a ready queue this runs in the background, so the indices of finished pdb files are queued instead of calling YASARA.
+    # returns the failed indices with their error, which also goes to the manifest with the number of attempts
+    from requests import RequestException
+    failed = {}
+    # new jobs and finished ones arrive on the same queue, as (index, job) and (index, job, future)
+    events = more or queue.Queue()
+    with ThreadPoolExecutor(max_workers=DL_WORKERS) as pool:
+        def submit(i, job):
+            pool.submit(download_timed, *job).add_done_callback(lambda future: events.put((i, job, future)))
+
+        for i, job in jobs.items():
+            submit(i, job)
+        total, running, joining = len(jobs), len(jobs), more is not None
+        n = 0
+        while running or joining:
+            event = events.get()
+            if event is None:
+                joining = False
+                continue
+            if len(event) == 2:
+                submit(*event)
+                total += 1
+                running += 1
+                continue
+            i, (server, id, outfile, chain), future = event
+            running -= 1
+            n += 1
+            try:
+                steps = future.result()
+                error = None if steps else 'not found'
+            except (RequestException, OSError) as e:
+                print(f'Failed to download {id}: {e}')
+                steps, error = [], str(e)
+            except ValueError as e:
+                print(f'Failed to convert {id}: {e}')
+                steps, error = [], 'not convertible'
+            ok = bool(steps)
+            if not ok:
+                failed[i] = error
+            print(f'[{n}/{total}] {"got" if ok else "failed"} {os.path.basename(outfile)}')
+            if manifest is not None:
+                attempts = manifest['hits'][i]['attempts'] + 1
+                if ok:
+                    # a new file starts over, the one it replaced may have been superposed already
+                    mark_hit(manifest, i, *steps, done=[], attempts=attempts, error=None)
+                else:
+                    mark_hit(manifest, i, attempts=attempts, error=error)
+            if ready is None:
+                ShowMessage(f'Downloaded {n} / {total} structures')
+            elif ok:
+                ready.put(i)
+    return failed
+
+
+def download_timed(server, id, outfile, chain):
+    # download_pdb, recording in run_stats where the entry came from (see find_structure)
+    # and, for network fetches, the latency and size of the fetched file
+    start = time.perf_counter()
+    src, source, fetched, ok = None, 'network', None, []
+    try:
+        src, source = find_structure(server, id)
+        fetched = time.perf_counter()
+        ok = download_pdb(src, outfile, chain) if src else []
+        return ok
+    finally:
+        with _stats_lock:
+            run_stats['downloads'].append({'id': id, 'server': server, 'source': source,
+                                           'seconds': round((fetched or time.perf_counter()) - start, 4),
+                                           'bytes': os.path.getsize(src) if src and source == 'network' else 0, 'ok': bool(ok)})
+
+
+def write_response(response, outfile, fix_lines=None):
+    # write to a temporary file and rename, so the cache never holds a truncated entry.
+    # fix_lines optionally rewrites the body line by line on its way to disk
+    tmp = cache_temp(outfile)
+    with open(tmp, 'wb') as file:
+        if fix_lines is None:
+            for chunk in response.iter_content(chunk_size=DL_CHUNK):
+                file.write(chunk)
+        else:
+            file.writelines(fix_lines(response.iter_lines(chunk_size=DL_CHUNK)))
+    os.replace(tmp, outfile)
+
+
+def fix_esm_lines(lines):
+    # ESM Atlas files can have their atom names shifted one column to the left; the first ATOM record tells
+    shifted = None
+    spent = 0
+    for line in lines:
+        start = time.perf_counter()
+        if line.startswith(b'ATOM'):
+            if shifted is None:
+                shifted = line[12:13] != b' '
+            if shifted:
+                line = _esm_shift.sub(rb'\1 \2\3', line)
+        spent += time.perf_counter() - start
+        yield line + b'\n'
+    add_time('esm fix', spent)
+
+
+def fetch_structure(server, id):
+    # download an entry into the structure cache, trying pdb format first and cif second
+    dbname = cache_db(server)
+    session = get_session(server)
     url = f'{server}/{id}.pdb'
-    response = get(url)
+    response = session.get(url, stream=True, timeout=DL_TIMEOUT)
     if response.status_code == 200:
-        with open(outfile, 'wb') as file:
-            file.write(response.content)
+        write_response(response, cache_path(dbname, id, '.pdb'), fix_lines=fix_esm_lines if server == ESM_SERVER else None)
+        return cache_path(dbname, id, '.pdb')
     elif response.status_code == 404:
+        # drain the error body so the connection goes back to the pool for the cif request
+        response.content
         url = f'{server}/{id}.cif'
-        response = get(url)
+        response = session.get(url, stream=True, timeout=DL_TIMEOUT)
         if response.status_code == 200:
-            with open(outfile.replace('pdb', 'cif'), 'wb') as file:
-                file.write(response.content)
-            convert_cif_to_pdb(outfile.replace('pdb', 'cif'), outfile)
+            write_response(response, cache_path(dbname, id, '.cif'))
+            return cache_path(dbname, id, '.cif')
+    print(f"Status code {response.status_code} caused failure to download file {url} ")
+    response.close()
+    return None
+
+
+def find_structure(server, id):
+    # cache first, then the local mirror, then the network; returns the entry's file, None if not found, and its source
+    src = cache_lookup(cache_db(server), id)
+    if src is not None:
+        return src, 'cache'
+    src = mirror_lookup(server, id)
+    if src is not None:
+        return src, 'mirror'
+    return fetch_structure(server, id), 'network'
+
+
+def download_pdb(src, outfile, chain=None):
+    # put the entry's file src (see find_structure) in the hits folder as outfile. only the hit chain goes there,
+    # the cache keeps the complete entry. cif entries are converted right here, in the download worker, so they are
+    # loaded as soon as they land. returns the steps done (see mark_hit)
+    steps = ['downloaded'] + (['trimmed'] if chain is not None else [])
+    if '.cif' not in src:
+        if chain is not None:
+            trim_pdb(src, outfile, chain)
+        elif src.endswith('.gz'):
+            gunzip_file(src, outfile)
         else:
-            print(f"Status code {response.status_code} caused failure to download file {url} ")
+            link_or_copy(src, outfile)
+        return steps
+    # a pdb of an earlier run must not stay in place if the conversion fails
+    if os.path.exists(outfile):
+        os.remove(outfile)
+    cif = src
+    if src.endswith('.gz'):
+        cif = os.path.splitext(outfile)[0] + '.cif'
+        gunzip_file(src, cif)
+    try:
+        with phase('cif conversion'):
+            convert_cif_to_pdb(cif, outfile, chain)
+    finally:
+        if cif != src:
+            os.remove(cif)
+    return steps + ['converted']
+
+
+def trim_pdb(src, dst, chain=None):
+    # stream the first model and, if given, one chain of a (gzipped) pdb file; the whole first model if the chain is missing
+    opener = gzip.open if src.endswith('.gz') else open
+    kept = 0
+    tmp = cache_temp(dst)
+    with opener(src, 'rt') as input_file, open(tmp, 'w') as output_file:
+        for line in input_file:
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith(('MODEL', 'CONECT', 'MASTER', 'END')):
+                continue
+            if line.startswith(('ATOM', 'HETATM', 'ANISOU', 'TER')):
+                if chain is not None and line[21:22] != chain:
+                    continue
+                kept += 1
+            output_file.write(line)
+        output_file.write('END\n')
+    if not kept and chain is not None:
+        print(f'Chain {chain} not found in {src}, keeping all chains.')
+        trim_pdb(src, tmp)
+    os.replace(tmp, dst)
+
+
+def submit_ticket(fquery, databases, mode='3diaa'):
+    with open(fquery, 'r') as pdb_file:
+        pdb_content = pdb_file.read()
+    return get_session(FOLDSEEK_SERVER).post(f'{FOLDSEEK_SERVER}/api/ticket',
+                files={'q': (pdb_content, pdb_content, 'application/octet-stream')},
+                data={
+                    'mode' : mode,
+                    'database[]' : databases,
+                }, timeout=DL_TIMEOUT).json()
+
+
+def wait_for_ticket(ticket_id):
+    # poll with a growing interval: quick jobs are picked up within a second, long ones don't flood the server
+    interval = POLL_START
+    while True:
+        status = get_session(FOLDSEEK_SERVER).get(f'{FOLDSEEK_SERVER}/api/ticket/{ticket_id}', timeout=DL_TIMEOUT).json()
+        if status['status'] in ('COMPLETE', 'ERROR'):
+            return status['status']
+        time.sleep(interval)
+        interval = min(interval * 1.5, POLL_MAX)
+
+
+def fetch_alignment(ticket_id, database, prefix):
+    # stream the result archive and extract only the alignment of the selected database to prefix + its name
+    response = get_session(FOLDSEEK_SERVER).get(f'{FOLDSEEK_SERVER}/api/result/download/{ticket_id}', stream=True, timeout=DL_TIMEOUT)
+    response.raise_for_status()
+    with tarfile.open(fileobj=response.raw, mode='r|gz', bufsize=DL_CHUNK * 16) as archive:
+        for member in archive:
+            name = os.path.basename(member.name)
+            if member.isfile() and name.startswith('ali') and name.endswith('m8') and database in name:
+                outfile = prefix + name
+                tmp = cache_temp(outfile)
+                with archive.extractfile(member) as input_file, open(tmp, 'wb') as output_file:
+                    shutil.copyfileobj(input_file, output_file, DL_CHUNK)
+                os.replace(tmp, outfile)
+                response.close()
+                return outfile
+    return None
+
+
+def run_ticket(fquery, databases, database, prefix):
+    # one complete web search (submit, poll, fetch) for a worker thread, so no YASARA calls in here.
+    # returns the ticket id and the alignment file, or None if the search failed
+    with phase('submit'):
+        ticket = submit_ticket(fquery, databases)
+    with phase('poll'):
+        status = wait_for_ticket(ticket['id'])
+    if status == 'ERROR':
+        return ticket['id'], None
+    with phase('fetch alignment'):
+        return ticket['id'], fetch_alignment(ticket['id'], database, prefix)
+
+
+def split_format_flags(options):
+    # foldseek convertalis takes the --format-* flags (with their values), search all others
+    tokens = options.split()
+    search_flags, format_flags = [], []
+    i = 0
+    while i < len(tokens):
+        if tokens[i].startswith('--format-'):
+            format_flags += tokens[i:i + 2]
+            i += 2
+        else:
+            search_flags.append(tokens[i])
+            i += 1
+    return ' '.join(search_flags), ' '.join(format_flags)
+
+
+def batch_search(fs, names, fsdb, options, outputdir, tag=''):
+    # search all queries q/<name>_fsquery.pdb with a single createdb + search + convertalis, so the
+    # database is read once for the whole batch, then split the alignment into alns/<name><tag>_aln per query
+    batch_dir = os.path.join(outputdir, 'tmp', 'batch' + tag)
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    os.makedirs(os.path.join(batch_dir, 'q'))
+    for name in names:
+        link_or_copy(f'{outputdir}/q/{name}_fsquery.pdb', f'{batch_dir}/q/{name}_fsquery.pdb')
+    search_flags, format_flags = split_format_flags(options)
+    commands = [f'{fs} createdb {batch_dir}/q {batch_dir}/querydb',
+                f'{fs} search {batch_dir}/querydb {fsdb} {batch_dir}/aln {batch_dir}/tmp --remove-tmp-files true {search_flags}',
+                f'{fs} convertalis {batch_dir}/querydb {fsdb} {batch_dir}/aln {batch_dir}/batch_aln {format_flags}']
+    for fs_command in commands:
+        print('Command:\n' + fs_command)
+        noerr = subprocess.run(fs_command, shell=True, capture_output=True, text=True)
+        for line in noerr.stdout.split('\n'):
+            print(line)
+        if noerr.returncode > 0:
+            return False
+
+    # the query column is the file name (plus chain), e.g. 1abc_fsquery.pdb_A
+    outfiles = {name: open(f'{outputdir}/alns/{name}{tag}_aln', 'w') for name in names}
+    try:
+        with open(f'{batch_dir}/batch_aln') as input_file:
+            for line in input_file:
+                query = line.split('\t', 1)[0]
+                if query == 'query':
+                    for output_file in outfiles.values():
+                        output_file.write(line)
+                    continue
+                name = query.rsplit('_fsquery', 1)[0]
+                if name in outfiles:
+                    outfiles[name].write(line)
+    finally:
+        for output_file in outfiles.values():
+            output_file.close()
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    return True
+
+
+def budget_flags(n_get, level, flags):
+    # --max-seqs and --max-accept for a search of n_get hits at a budget level; none for level None or "All",
+    # so foldseek's defaults apply. limits set by the user in flags are kept
+    if level is None or n_get == 'all':
+        return ''
+    budget = {'--max-seqs': max(BUDGET_MIN_SEQS, n_get * level), '--max-accept': n_get * level}
+    return ''.join(f' {flag} {value}' for flag, value in budget.items() if flag not in flags)
+
+
+def read_hits(aln_file, columns, n_get='all'):
+    # stream an alignment table in rank order and keep the first row of each target (the part before a space),
+    # until n_get unique targets are found, so the rest of a large file is never read.
+    # returns the hit ids and {hit: {column: value}} of their rows; a --format-mode 4 header replaces columns.
+    # blank lines are skipped, an empty result is a single newline
+    hits, rows = [], {}
+    with open(aln_file) as input_file:
+        for n, line in enumerate(input_file):
+            if not line.strip():
+                continue
+            values = line.rstrip('\n').split('\t')
+            if n == 0 and values[0] == 'query':
+                columns = values
+                continue
+            hit = values[columns.index('target') if 'target' in columns else 1].split(' ')[0]
+            if hit in rows:
+                continue
+            hits.append(hit)
+            rows[hit] = dict(zip(columns, values))
+            if n_get != 'all' and len(hits) >= n_get:
+                break
+    return hits, rows
+
+
+def save_table(aln_file, columns):
+    # keep the complete alignment table as gzipped JSON, one list per column with numbers converted
+    table = {column: [] for column in columns}
+    with open(aln_file) as input_file:
+        for n, line in enumerate(input_file):
+            if not line.strip():
+                continue
+            values = line.rstrip('\n').split('\t')
+            if n == 0 and values[0] == 'query':
+                table = {column: [] for column in values}
+                continue
+            for column, value in zip(table, values):
+                table[column].append(value)
+    for column, values in table.items():
+        for number in (int, float):
+            try:
+                table[column] = [number(x) for x in values]
+                break
+            except ValueError:
+                pass
+    tmp = cache_temp(aln_file + '.json.gz')
+    with gzip.open(tmp, 'wt') as output_file:
+        json.dump(table, output_file, separators=(',', ':'))
+    os.replace(tmp, aln_file + '.json.gz')
+
+
+def local_search(fs, names, fsdb, options, outputdir, tag=''):
+    # search the queries q/<name>_fsquery.pdb in fsdb and write alns/<name><tag>_aln: one with easy-search,
+    # several as a batch. no YASARA calls, so several databases can be searched in parallel threads
+    if len(names) > 1:
+        return batch_search(fs, names, fsdb, options, outputdir, tag)
+    aln_file = f'{outputdir}/alns/{names[0]}{tag}_aln'
+    fs_command = f'{fs} easy-search {outputdir}/q/{names[0]}_fsquery.pdb {fsdb} {aln_file} {outputdir}/tmp/search{tag} --remove-tmp-files true {options}'
+    print('Command:\n' + fs_command)
+    noerr = subprocess.run(fs_command, shell=True, capture_output=True, text=True)
+    for line in noerr.stdout.split('\n'):
+        print(line)
+    return noerr.returncode == 0 and os.path.exists(aln_file)
+
+
+def merge_hits(alns, columns, n_get, outfile):
+    # rank the hits of several databases together by e-value (then bits), keep the best row of each target and
+    # write the first n_get to one alignment file. alns are (aln file, server) pairs; returns {hit: server}
+    merged = []
+    for aln_file, server in alns:
+        hits, rows = read_hits(aln_file, columns, n_get)
+        merged += [(hit, rows[hit], server) for hit in hits]
+
+    def rank(item):
+        try:
+            return float(item[1].get('evalue', 'inf')), -float(item[1].get('bits', 0))
+        except ValueError:
+            return math.inf, 0
+
+    servers = {}
+    tmp = cache_temp(outfile)
+    with open(tmp, 'w') as output_file:
+        for hit, row, server in sorted(merged, key=rank):
+            if hit in servers:
+                continue
+            if n_get != 'all' and len(servers) >= n_get:
+                break
+            servers[hit] = server
+            output_file.write('\t'.join(row.values()) + '\n')
+    os.replace(tmp, outfile)
+    return servers
+
+
+def read_ca(pdb_file):
+    # CA coordinates of the first model per chain, in residue order
+    chains = {}
+    with open(pdb_file) as file:
+        for line in file:
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith(('ATOM', 'HETATM')) and line[12:16] == ' CA ' and line[16] in ' A':
+                chains.setdefault(line[21], []).append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+    return chains
+
+
+def aligned_pairs(qstart, tstart, qaln, taln):
+    # 0-based (query, target) residue indices of the aligned, ungapped columns
+    qi, ti = int(qstart) - 1, int(tstart) - 1
+    for q, t in zip(qaln, taln):
+        if q != '-' and t != '-':
+            yield qi, ti
+        qi += q != '-'
+        ti += t != '-'
+
+
+def largest_eigenvector(a):
+    # cyclic Jacobi rotations, good enough for the small symmetric matrices used here
+    n = len(a)
+    a = [row[:] for row in a]
+    v = [[float(i == j) for j in range(n)] for i in range(n)]
+    for sweep in range(50):
+        if sum(a[i][j] ** 2 for i in range(n) for j in range(n) if i != j) < 1e-20:
+            break
+        for p in range(n - 1):
+            for q in range(p + 1, n):
+                if a[p][q] == 0:
+                    continue
+                theta = (a[q][q] - a[p][p]) / (2 * a[p][q])
+                t = (1 if theta >= 0 else -1) / (abs(theta) + math.sqrt(theta * theta + 1))
+                c = 1 / math.sqrt(t * t + 1)
+                s = t * c
+                for m in (a, v):
+                    for k in range(n):
+                        m[k][p], m[k][q] = c * m[k][p] - s * m[k][q], s * m[k][p] + c * m[k][q]
+                for k in range(n):
+                    a[p][k], a[q][k] = c * a[p][k] - s * a[q][k], s * a[p][k] + c * a[q][k]
+    best = max(range(n), key=lambda i: a[i][i])
+    return [v[k][best] for k in range(n)]
+
+
+def superposition(mobile, fixed):
+    # least-squares rotation r and translation t with r * mobile + t ~ fixed (Horn's quaternion method)
+    mc = [sum(x[k] for x in mobile) / len(mobile) for k in range(3)]
+    fc = [sum(x[k] for x in fixed) / len(fixed) for k in range(3)]
+    s = [[sum((x[a] - mc[a]) * (y[b] - fc[b]) for x, y in zip(mobile, fixed)) for b in range(3)] for a in range(3)]
+    (sxx, sxy, sxz), (syx, syy, syz), (szx, szy, szz) = s
+    q0, q1, q2, q3 = largest_eigenvector([[sxx + syy + szz, syz - szy, szx - sxz, sxy - syx],
+                                          [syz - szy, sxx - syy - szz, sxy + syx, szx + sxz],
+                                          [szx - sxz, sxy + syx, syy - sxx - szz, syz + szy],
+                                          [sxy - syx, szx + sxz, syz + szy, szz - sxx - syy]])
+    r = [[q0*q0 + q1*q1 - q2*q2 - q3*q3, 2 * (q1*q2 - q0*q3), 2 * (q1*q3 + q0*q2)],
+         [2 * (q1*q2 + q0*q3), q0*q0 - q1*q1 + q2*q2 - q3*q3, 2 * (q2*q3 - q0*q1)],
+         [2 * (q1*q3 - q0*q2), 2 * (q2*q3 + q0*q1), q0*q0 - q1*q1 - q2*q2 + q3*q3]]
+    return r, [fc[a] - sum(r[a][b] * mc[b] for b in range(3)) for a in range(3)]
+
+
+def local_transforms(rows, hits):
+    # easy-search u/t move the query onto the target; inverted they move each hit onto the query
+    transforms = {}
+    for row in rows:
+        if row.get('target') not in hits or row['target'] in transforms or not row.get('u') or not row.get('t'):
+            continue
+        try:
+            u = [float(x) for x in row['u'].split(',')]
+            t = [float(x) for x in row['t'].split(',')]
+        except ValueError:
+            continue
+        if len(u) == 9 and len(t) == 3:
+            r = [[u[b * 3 + a] for b in range(3)] for a in range(3)]
+            transforms[row['target']] = (r, [-sum(r[a][b] * t[b] for b in range(3)) for a in range(3)])
+    return transforms
+
+
+def web_transforms(rows, hits, fquery):
+    # superpose the target CA coordinates (tca) onto the query CAs paired by the server alignment (qaln/taln)
+    query_ca = read_ca(fquery)
+    transforms = {}
+    for row in rows:
+        hit = row['target'].split(' ')[0]
+        if hit not in hits or hit in transforms or not row.get('tca') or not row.get('taln'):
+            continue
+        ca = query_ca.get(row['query'].split('_')[-1]) or next(iter(query_ca.values()), [])
+        tca = [float(x) for x in row['tca'].split(',')]
+        pairs = [(i, j) for i, j in aligned_pairs(row['qstart'], row['tstart'], row['qaln'], row['taln']) if i < len(ca) and 3 * j + 2 < len(tca)]
+        if len(pairs) >= 3:
+            transforms[hit] = superposition([tca[3 * j:3 * j + 3] for i, j in pairs], [ca[i] for i, j in pairs])
+    return transforms
+
+
+def superpose_file(pdb_file, transform):
+    # rewrite the coordinates; replaces the file, so a hardlinked cache entry stays untouched
+    r, t = transform
+    tmp = cache_temp(pdb_file)
+    with open(pdb_file) as input_file, open(tmp, 'w') as output_file:
+        for line in input_file:
+            if line.startswith(('ATOM', 'HETATM')):
+                x = [float(line[30:38]), float(line[38:46]), float(line[46:54])]
+                x = [sum(r[a][b] * x[b] for b in range(3)) + t[a] for a in range(3)]
+                line = f'{line[:30]}{x[0]:8.3f}{x[1]:8.3f}{x[2]:8.3f}{line[54:]}'
+            output_file.write(line)
+    os.replace(tmp, pdb_file)
+
+
+def load_pdbs(pdbs, outdir, target, ready=None, transforms=None, refine=True, meta=None, pages=None, manifest=None):
+    # homologs are aligned onto object target. with a ready queue (see start_pdbs) homologs are loaded as their downloads finish, while the rest continue.
+    # non-homologous chains and extra models were already removed from the files by get_pdbs.
+    # hits with a FoldSeek transform are superposed directly and only aligned with SHEBA if refine is set.
+    # meta (one dict per hit, see store_hits) is saved in the hit store under the name of the loaded object.
+    # with pages (see save_pages) every aligned hit is saved as .yob and only the first page stays loaded.
+    # with a manifest, hits an earlier run aligned are kept if still loaded, and files are never superposed twice
+    last_message = 0
+    load_start = time.perf_counter()
+    records = []
+    if pages is not None:
+        offset = pages['count']
+        pages['count'] += len(pdbs)
+    if transforms:
+        target_pos, target_ori = PosObj(target), OriObj(target)
+    for n, i in enumerate(iter(ready.get, None) if ready else range(len(pdbs)), 1):
+        if not os.path.exists(f'{outdir}{i+1}_{pdbs[i]}.pdb'):
+            continue
+        done = manifest['hits'][i]['done'] if manifest else []
+        if 'aligned' in done:
+            obj = loaded_object(manifest['hits'][i])
+            if pages is not None and os.path.exists(f'{outdir}{i+1}_{pdbs[i]}.yob'):
+                pages['files'].append((offset + i, f'{outdir}{i+1}_{pdbs[i]}.yob'))
+                if offset + i < pages['size']:
+                    pages['loaded'].append(obj or min(LoadYOb(f'{outdir}{i+1}_{pdbs[i]}.yob')))
+                elif obj:
+                    DelObj(obj)
+                continue
+            if pages is None and obj:
+                continue
+        if time.perf_counter() - last_message > MSG_INTERVAL:
+            ShowMessage(f'Loading homolog {n} / {len(pdbs)}')
+            Wait(1)
+            last_message = time.perf_counter()
+        transform = transforms[i] if transforms else None
+        if transform and 'superposed' not in done:
+            with phase('superpose'):
+                superpose_file(f'{outdir}{i+1}_{pdbs[i]}.pdb', transform)
+            mark_hit(manifest, i, 'superposed')
+        with phase('load'):
+            # superposed files must keep their coordinates, YASARA would center them otherwise
+            new = LoadPDB(f'{outdir}{i+1}_{pdbs[i]}.pdb', center='No' if transform else None)
+            [DelObj(i) for i in new if i > min(new)]
+            HideObj(min(new))
+        name = NameObj(min(new))[0]
+        mark_hit(manifest, i, 'loaded', object=min(new), name=name)
+        if transform:
+            # the coordinates are now in the local frame of the query, as saved with transform='No', so place the hit like the target
+            PosObj(min(new), *target_pos)
+            OriObj(min(new), *target_ori)
+        if refine or not transform:
+            with phase('sheba'):
+                AlignObj(min(new), target, 'sheba')
+        if meta:
+            records.append(dict(meta[i], object=name, path=f'{outdir}{i+1}_{pdbs[i]}.pdb',
+                                seconds=time.perf_counter() - load_start))
+        if pages is not None:
+            SaveYOb(min(new), f'{outdir}{i+1}_{pdbs[i]}.yob')
+            pages['files'].append((offset + i, f'{outdir}{i+1}_{pdbs[i]}.yob'))
+            if offset + i < pages['size']:
+                pages['loaded'].append(min(new))
+            else:
+                DelObj(min(new))
+                mark_hit(manifest, i, object=None)
+        mark_hit(manifest, i, 'aligned')
+    if records:
+        store_hits(records)
+
+
+def save_pages(pages):
+    # the aligned .yob files of an "All" run in rank order, the current page and the objects loaded from it,
+    # for the Next page / Previous page buttons
+    tmp = cache_temp(PAGES_FILE)
+    with open(tmp, 'w') as file:
+        json.dump({'size': pages['size'], 'page': pages['page'], 'loaded': pages['loaded'],
+                   'files': [path for position, path in sorted(pages['files'])]}, file)
+    os.replace(tmp, PAGES_FILE)
+
+
+def open_manifest(path, key, resume, **info):
+    # the job manifest of one query: its search, its hits and the steps each hit got through (see mark_hit).
+    # with resume, the manifest an earlier run left for the same key (see query_hash) is continued, else a new one is started
+    manifest = None
+    if resume:
+        try:
+            with open(path) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            print(f'No earlier run to resume in {path}, starting a new one.')
+        if manifest is not None and manifest['key'] != key:
+            print(f'The earlier run in {path} searched something else, starting a new one.')
+            manifest = None
+    if manifest is None:
+        manifest = {'key': key, 'created': time.time(), 'runs': 0, 'alns': [], 'hits': []}
+    else:
+        print(f"Resuming the run of {time.ctime(manifest['created'])} from {path}")
+    manifest.update(info, path=path, runs=manifest['runs'] + 1)
+    save_manifest(manifest, force=True)
+    return manifest
+
+
+def resumed_alns(manifest):
+    # the search output of the earlier run of a manifest, if all of it is still there
+    if manifest['runs'] > 1 and manifest['alns'] and all(os.path.exists(x) for x in manifest['alns']):
+        return manifest['alns']
+
+
+def manifest_hits(manifest, hits, pdbs, chains, servers, dir, trim):
+    # set the hit list; a hit keeps its state from the earlier run if it goes to the same file, trimmed the same way
+    earlier = {(x['target'], x['file'], x['trim']): x for x in manifest['hits']}
+    manifest['hits'] = []
+    for i in range(len(hits)):
+        file = f'{dir}{i+1}_{pdbs[i]}.pdb'
+        manifest['hits'].append(earlier.get((hits[i], file, trim)) or
+                                {'target': hits[i], 'id': pdbs[i], 'chain': chains[i], 'server': servers[i], 'file': file,
+                                 'trim': trim, 'done': [], 'attempts': 0, 'error': None})
+    save_manifest(manifest, force=True)
+
+
+def mark_hit(manifest, i, *steps, **fields):
+    # record the finished steps (downloaded, converted, trimmed, superposed, loaded, aligned) and other fields of hit i.
+    # fields are set first, so done=[] starts a hit over
+    if manifest is None:
+        return
+    with _manifest_lock:
+        hit = manifest['hits'][i]
+        hit.update(fields)
+        hit['done'] = hit['done'] + [step for step in steps if step not in hit['done']]
+        save_manifest(manifest)
+
+
+def save_manifest(manifest, force=False):
+    # written like the cache entries; unless forced at most every MANIFEST_INTERVAL seconds, as hits are marked one by one
+    with _manifest_lock:
+        if not force and time.time() - manifest['updated'] < MANIFEST_INTERVAL:
+            return
+        manifest['updated'] = time.time()
+        tmp = cache_temp(manifest['path'])
+        with open(tmp, 'w') as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(tmp, manifest['path'])
+
+
+def loaded_object(hit):
+    # the object a manifest hit was loaded as, if it is still there
+    obj = hit.get('object')
+    if obj is not None and CountObj(obj) and NameObj(obj)[0] == hit.get('name'):
+        return obj
+
+
+def hit_store():
+    # sqlite store of all loaded hits in CACHE_DIR, shared by runs, output folders and YASARA sessions.
+    # one row per object name and query, the latest run wins
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    con = sqlite3.connect(os.path.join(CACHE_DIR, 'hits.sqlite'), timeout=30)
+    con.execute(f'CREATE TABLE IF NOT EXISTS hits ({", ".join(HIT_FIELDS)}, PRIMARY KEY (object, query))')
+    con.execute('CREATE INDEX IF NOT EXISTS hits_accession ON hits (accession)')
+    con.execute(f'CREATE TABLE IF NOT EXISTS annotations ({", ".join(ANNOTATION_FIELDS)}, PRIMARY KEY (accession))')
+    return con
+
+
+def store_hits(records):
+    # records are dicts with the HIT_FIELDS; columns is the alignment row as a dict, seconds the time until it was loaded
+    rows = [tuple(json.dumps(record['columns']) if field == 'columns' else record.get(field, time.time() if field == 'created' else None)
+                  for field in HIT_FIELDS) for record in records]
+    with closing(hit_store()) as con, con:
+        con.executemany(f'INSERT OR REPLACE INTO hits VALUES ({", ".join("?" * len(HIT_FIELDS))})', rows)
+
+
+def find_hit(name):
+    # the latest hit loaded as object name, else the latest with its accession (the name without the rank prefix)
+    with closing(hit_store()) as con:
+        row = (con.execute('SELECT * FROM hits WHERE object = ? ORDER BY created DESC LIMIT 1', (name,)).fetchone() or
+               con.execute('SELECT * FROM hits WHERE accession = ? ORDER BY created DESC LIMIT 1', (re.sub('^[0-9]+_', '', name),)).fetchone())
+    if row is None:
+        return None
+    hit = dict(zip(HIT_FIELDS, row))
+    hit['columns'] = json.loads(hit['columns'])
+    return hit
+
+
+def uniprot_accession(accession):
+    # AlphaFold DB entries are named by UniProt accession, AF-P12345-F1-model_v4 -> P12345
+    return re.sub('^AF-(.+?)-F[0-9]+.*', r'\1', accession)
+
+
+def cached_annotations(accessions, max_age=None):
+    # {accession: annotation} from the store; with max_age (seconds) only those fetched since then
+    annotations = {}
+    with closing(hit_store()) as con:
+        for i in range(0, len(accessions), 500):
+            batch = accessions[i:i + 500]
+            for row in con.execute(f'SELECT * FROM annotations WHERE accession IN ({", ".join("?" * len(batch))})', batch):
+                annotation = dict(zip(ANNOTATION_FIELDS, row))
+                if max_age is None or time.time() - annotation['fetched'] < max_age:
+                    annotations[annotation['accession']] = annotation
+    return annotations
+
+
+def fetch_rcsb_annotations(ids):
+    # one GraphQL request for a batch of PDB entries
+    response = get_session(RCSB_GRAPHQL).post(RCSB_GRAPHQL, json={'query': RCSB_QUERY, 'variables': {'ids': [x.upper() for x in ids]}}, timeout=DL_TIMEOUT)
+    response.raise_for_status()
+    accessions = {x.upper(): x for x in ids}
+    annotations = []
+    for entry in response.json()['data']['entries'] or []:
+        if not entry or entry['rcsb_id'].upper() not in accessions:
+            continue
+        organisms = [source['scientific_name'] for entity in entry.get('polymer_entities') or []
+                     for source in entity.get('rcsb_entity_source_organism') or [] if source.get('scientific_name')]
+        resolution = (entry.get('rcsb_entry_info') or {}).get('resolution_combined') or [None]
+        annotations.append({'accession': accessions[entry['rcsb_id'].upper()],
+                            'title': (entry.get('struct') or {}).get('title'),
+                            'organism': ', '.join(dict.fromkeys(organisms)) or None,
+                            'doi': (entry.get('rcsb_primary_citation') or {}).get('pdbx_database_id_DOI'),
+                            'resolution': resolution[0]})
+    return annotations
+
+
+def fetch_afdb_annotations(ids):
+    # the AlphaFold DB API has no batch requests, ids are fetched one by one
+    annotations = []
+    for id in ids:
+        response = get_session(AFDB_API).get(f'{AFDB_API}/{uniprot_accession(id)}', timeout=DL_TIMEOUT)
+        if response.status_code == 404:
+            continue
+        response.raise_for_status()
+        entry = (response.json() or [{}])[0]
+        annotations.append({'accession': id, 'title': entry.get('uniprotDescription'),
+                            'organism': entry.get('organismScientificName'), 'doi': None, 'resolution': None})
+    return annotations
+
+
+def fetch_annotations(accessions, server):
+    # title, organism, DOI and resolution of the entries of one download server, fetched in concurrent batches
+    # and stored as each batch arrives, so a run that ends before all are fetched keeps what it got.
+    # ESM Atlas entries have no annotations
+    from requests import RequestException
+    if server == RCSB_SERVER:
+        fetch, size = fetch_rcsb_annotations, ANNOTATION_BATCH
+    elif server == AFDB_SERVER:
+        fetch, size = fetch_afdb_annotations, 1
     else:
-        print(f"Status code {response.status_code} caused failure to download file {url} ")
-
-
-def load_pdbs(pdbs, mols, outdir, del_homologs):
-    for i in range(len(pdbs)):
-        ShowMessage(f'Loading homolog {i + 1} / {len(pdbs)}')
-        Wait(1)
-        new = LoadPDB(f'{outdir}{i+1}_{pdbs[i]}.pdb')
-        # could do for all structures in nmr bundles
-        # [HideObj(i) for i in new]
-        # [DelMol(f'obj {i} mol !{mols[i]}') for i in new]
-        # [AlignObj(i, target, 'sheba') for i in new]
-        [DelObj(i) for i in new if i > min(new)]
-        HideObj(min(new))
-        if del_homologs:
-            DelMol(f'obj {min(new)} mol !{mols[i]}')
-        AlignObj(min(new), target, 'sheba')
-
-
-def ShowButtons(dlserver):
+        return []
+    batches = [accessions[i:i + size] for i in range(0, len(accessions), size)]
+    annotations = []
+    with ThreadPoolExecutor(max_workers=max(1, min(ANNOTATION_WORKERS, len(batches)))) as pool, closing(hit_store()) as con:
+        for future in as_completed([pool.submit(fetch, batch) for batch in batches]):
+            try:
+                batch = future.result()
+            except (RequestException, OSError, ValueError, KeyError, TypeError) as e:
+                print(f'Failed to get annotations: {e}')
+                continue
+            rows = [tuple(annotation.get(field, time.time() if field == 'fetched' else None) for field in ANNOTATION_FIELDS)
+                    for annotation in batch]
+            with con:
+                con.executemany(f'INSERT OR REPLACE INTO annotations VALUES ({", ".join("?" * len(ANNOTATION_FIELDS))})', rows)
+            annotations += batch
+    return annotations
+
+
+def start_annotations(accessions, servers):
+    # fetch the annotations of the hits that are not cached or expired in the background, while they download.
+    # returns the thread, which should be joined before the plugin ends
+    def produce():
+        fresh = cached_annotations(accessions, max_age=ANNOTATION_TTL_DAYS * 86400)
+        todo = {}
+        for accession, server in zip(accessions, servers):
+            if accession not in fresh:
+                todo.setdefault(server, []).append(accession)
+        with phase('annotations'):
+            for server, ids in todo.items():
+                fetch_annotations(ids, server)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    return thread
+
+
+def ShowButtons(dlserver, paged=False):
     img = MakeImage("Buttons",topcol="None",bottomcol="None")
     ShowImage(img,alpha=66,priority=0)
     PrintImage(img)
     Font("Arial",height=14,color="black")
 
+    if paged:
+        ShowButton("Previous page",x='12%', y='55%',color="White", height=40)
+        ShowButton("Next page",x='12%', y='60%',color="White", height=40)
+
     ShowButton("Show info",x='12%', y='65%',color="White", height=40)
     ShowButton("Open structure entry",x='12%', y='70%',color="White", height=40)
-    if dlserver == 'https://files.rcsb.org/view':
+    if dlserver == RCSB_SERVER:
         ShowButton("Open primary article",x='12%', y='75%',color="White", height=40)
         ShowButton("Exit",x='12%', y='80%',color="Red", height=40)
-    else
+    else:
         ShowButton("Exit",x='12%', y='75%',color="Red", height=40)
 
 
 from yasara import *
 import os
 import re
-from requests import get, post
+import math
+import time
+import shutil
+import gzip
+import json
+import hashlib
+import sqlite3
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from urllib.parse import urlsplit
 from tempfile import gettempdir
 
+### settings
+RCSB_SERVER = os.environ.get('FS_PLG_RCSB_SERVER', 'https://files.rcsb.org/view')
+AFDB_SERVER = os.environ.get('FS_PLG_AFDB_SERVER', 'https://alphafold.ebi.ac.uk/files')
+ESM_SERVER = os.environ.get('FS_PLG_ESM_SERVER', 'https://api.esmatlas.com/fetchPredictedStructure')
+
+# more than RSYNC_MIN missing pdb entries are fetched from the wwPDB rsync server instead
+RSYNC_MIN = int(os.environ.get('FS_PLG_RSYNC_MIN', 20))
+RSYNC_SOURCE = os.environ.get('FS_PLG_RSYNC_SOURCE', 'rsync.wwpdb.org::ftp/data/structures/all/pdb/')
+
+# parallel downloads, retried with exponential backoff on connection errors and 429/5xx
+DL_WORKERS = int(os.environ.get('FS_PLG_DL_WORKERS', 8))
+DL_RETRIES = int(os.environ.get('FS_PLG_DL_RETRIES', 3))
+DL_TIMEOUT = 60
+# files that failed anyway are tried again after DL_RETRY_WAIT seconds, growing, up to DL_ATTEMPTS times in total
+DL_ATTEMPTS = int(os.environ.get('FS_PLG_DL_ATTEMPTS', 3))
+DL_RETRY_WAIT = 5
+DL_CHUNK = 1 << 16
+
+# FoldSeek web API, polled from POLL_START seconds growing to POLL_MAX
+FOLDSEEK_SERVER = os.environ.get('FS_PLG_FOLDSEEK_SERVER', 'https://search.foldseek.com')
+POLL_START = 0.25
+POLL_MAX = 10
+# with several query objects, at most this many web searches run at once
+MAX_TICKETS = int(os.environ.get('FS_PLG_MAX_TICKETS', 4))
+
+# databases (numbers of the PDB, SwissProt and UniProt50 choices) searched together by the combined choice
+MERGED_DBS = [int(x) for x in os.environ.get('FS_PLG_MERGED_DBS', '1,2').split(',')]
+
+# local searches for n_get hits first prefilter max(BUDGET_MIN_SEQS, n_get * level) targets and accept
+# n_get * level alignments, for each level in turn until enough unique hits were found
+BUDGET_LEVELS = [int(x) for x in os.environ.get('FS_PLG_BUDGET_LEVELS', '5,20').split(',') if x]
+BUDGET_MIN_SEQS = 100
+
+# columns of the web server's alignment files
+SERVER_COLUMNS = 'query,target,pident,alnlen,mismatch,gapopen,qstart,qend,tstart,tend,prob,evalue,bits,qlen,tlen,qaln,taln,tca,tseq,taxid,taxname'.split(',')
+
+# local easy-search output; u and t are FoldSeek's superposition of the query onto each hit
+LOCAL_COLUMNS = 'query,target,fident,alnlen,mismatch,gapopen,qstart,qend,tstart,tend,evalue,bits,u,t'.split(',')
+
+# local FoldSeek databases <FS_PLG_DB_DIR>/<name> for the PDB, AlphaFold SwissProt and UniProt50 choices
+DB_DIR = os.environ.get('FS_PLG_DB_DIR', '/usr/local/bin/foldseek')
+DB_NAMES = os.environ.get('FS_PLG_DB_NAMES', 'pd,sp,up50').split(',')
+# indexed databases are memory mapped (--db-load-mode 2), so repeated runs share the OS page cache
+DB_LOAD_MODE = os.environ.get('FS_PLG_DB_LOAD_MODE', '2')
+
+# where foldseek and its databases were found, see discover_foldseek
+DISCOVERY_FILE = os.path.join(gettempdir(), 'fs_plg_discovery.json')
+DISCOVERY_TTL_DAYS = 1
+
+# also keep the complete alignment table next to it as <aln>.json.gz (columnar, gzipped) if set
+SAVE_TABLE = os.environ.get('FS_PLG_SAVE_TABLE', '') not in ('', '0')
+
+# annotations (title, organism, DOI, resolution) of the hits are prefetched while downloading and kept for
+# ANNOTATION_TTL_DAYS, by at most ANNOTATION_WORKERS requests at a time; the end of a run waits at most
+# ANNOTATION_WAIT seconds for them
+RCSB_GRAPHQL = os.environ.get('FS_PLG_RCSB_GRAPHQL', 'https://data.rcsb.org/graphql')
+AFDB_API = os.environ.get('FS_PLG_AFDB_API', 'https://alphafold.ebi.ac.uk/api/prediction')
+ANNOTATION_TTL_DAYS = float(os.environ.get('FS_PLG_ANNOTATION_TTL_DAYS', 30))
+ANNOTATION_BATCH = 50
+ANNOTATION_WORKERS = 4
+ANNOTATION_WAIT = 10
+RCSB_QUERY = '''query($ids: [String!]!) {
+  entries(entry_ids: $ids) {
+    rcsb_id
+    struct { title }
+    rcsb_primary_citation { pdbx_database_id_DOI }
+    rcsb_entry_info { resolution_combined }
+    polymer_entities { rcsb_entity_source_organism { scientific_name } }
+  }
+}'''
+
+# "All" results are kept loaded PAGE_SIZE objects at a time, the others are swapped in from disk
+PAGE_SIZE = int(os.environ.get('FS_PLG_PAGE_SIZE', 50))
+PAGES_FILE = os.path.join(gettempdir(), 'fs_plg_pages.json')
+
+# FS_PLG_PROFILE=1 also profiles a search run with cProfile, saved next to its run report
+PROFILE = os.environ.get('FS_PLG_PROFILE', '') not in ('', '0')
+
+# minimum seconds between progress messages while loading
+MSG_INTERVAL = 0.5
+# minimum seconds between rewrites of a run's manifest while its hits are downloaded and loaded
+MANIFEST_INTERVAL = 2
+
+# structure cache shared by all runs, targets and YASARA sessions, trimmed to its size cap (LRU)
+CACHE_DIR = os.environ.get('FS_PLG_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'yasara_foldseek'))
+CACHE_MAX_MB = int(os.environ.get('FS_PLG_CACHE_MAX_MB', 5000))
+
+# FoldSeek results are reused for the same query coordinates, database and options
+SEARCH_TTL_DAYS = float(os.environ.get('FS_PLG_SEARCH_TTL_DAYS', 7))
+SEARCH_CACHE_MAX = int(os.environ.get('FS_PLG_SEARCH_CACHE_MAX', 200))
+
+# local mirrors, checked before the network: wwPDB divided layout (<root>/ab/pdb1abc.ent.gz) and AlphaFold DB shards
+PDB_MIRROR = os.environ.get('FS_PLG_PDB_MIRROR', '')
+AFDB_MIRROR = os.environ.get('FS_PLG_AFDB_MIRROR', '')
+
+ANNOTATION_FIELDS = ['accession', 'title', 'organism', 'doi', 'resolution', 'fetched']
+HIT_FIELDS = ['object', 'accession', 'query', 'target', 'server', 'path', 'columns', 'created', 'seconds']
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_mirror_indexes = {}
+_mirror_lock = threading.Lock()
+_cif_token = re.compile(r"""'[^']*'|"[^"]*"|\S+""")
+_cif_columns = {'group': ['group_PDB'], 'element': ['type_symbol'], 'name': ['auth_atom_id', 'label_atom_id'], 'alt': ['label_alt_id'],
+                'resn': ['auth_comp_id', 'label_comp_id'], 'chain': ['auth_asym_id', 'label_asym_id'], 'resi': ['auth_seq_id', 'label_seq_id'],
+                'icode': ['pdbx_PDB_ins_code'], 'x': ['Cartn_x'], 'y': ['Cartn_y'], 'z': ['Cartn_z'], 'occ': ['occupancy'],
+                'b': ['B_iso_or_equiv'], 'charge': ['pdbx_formal_charge'], 'model': ['pdbx_PDB_model_num']}
+_esm_shift = re.compile(rb'^(ATOM +[0-9]+)( *[A-Z0-9]+) (.*)')
+_mirror_file = re.compile(r'^(?:pdb)?(.+?)\.(?:ent|pdb|cif)(?:\.gz)?$')
+cache_stats = {'hits': 0, 'misses': 0, 'mirror': 0}
+run_stats = {'phases': {}, 'downloads': [], 'search_cache': 0}
+_stats_lock = threading.Lock()
+_manifest_lock = threading.RLock()
+
 Console('OFF')
 
 if request == 'foldseek':
@@ -147,23 +1553,24 @@ if request == 'foldseek':
     import importlib
     import subprocess
     import sys
-    import shutil
     from datetime import timedelta
 
-    ### get foldseek executable by trying `which`, then chcecking conda bin dir, then searching everywhere
-    fs = shutil.which('foldseek')
-    if not fs:
-        if os.path.exists(os.path.dirname(os.environ.get('CONDA_EXE', None)) + os.path.sep + 'foldseek'):
-            fs = os.path.dirname(os.environ.get('CONDA_EXE', None)) + os.path.sep + 'foldseek'
-        else:
-            fs = find_subfolder('foldseek', 'bin', '/')
-            if fs:
-                fs = fs + '/bin/foldseek'
-
-    if fs:
-        version = re.search('(?<=Version: ).*', subprocess.run(f'{fs} -h', shell=True, capture_output=True, text=True).stdout).group()
+    # background annotation prefetches of all targets, and the job manifest of each, see open_manifest
+    annotating = []
+    manifests = {}
+
+    if PROFILE:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    ### get foldseek executable and version, cached between runs
+    found = discover_foldseek()
+    fs, version = found['path'], found['version']
+    online_only = not (fs and version)
+    if not online_only:
         print(f'Using foldseek version {version} at {fs}')
-        online_only = False
 
 
     ### ONLINE FOLDSEEEK
@@ -174,7 +1581,7 @@ if request == 'foldseek':
             os.remove(os.path.join(gettempdir(), 'fs_plg_runonline'))
 
         start_time = time.perf_counter()
-        db, del_homologs, n_get, get_all, out_dir =\
+        db, del_homologs, n_get, get_all, refine, resume, out_dir =\
             ShowWin("Custom", "Foldseek Webserver Parameters", 600, 355,
                 "Text", 20, 48, "Choose database:",
                 "RadioButtons", 5, 1,
@@ -186,18 +1593,18 @@ if request == 'foldseek':
                 "CheckBox", 265, 48, "Delete non-homologous chains", True,
                 "NumberInput", 265, 90, "Number of structures to retrieve", 20, 1, 1000,
                 "CheckBox", 390, 107, "All", False,
+                "CheckBox", 265, 160, "Refine superposition with SHEBA", False,
+                "CheckBox", 265, 195, "Resume the last run of these objects", False,
                 "TextInput", 20, 255, "Output folder (current folder if empty)", 550, 100,
                 "Button", 281, 315, "_O_ K")
         
-        databases = ['afdb50', 'afdb-swissprot', 'afdb-proteome', 'cath50', 'mgnify_esm30', 'pdb100', 'gmgcl_id']
+        # in the order of the radio buttons, the server searches all of them but only the chosen one is fetched
+        databases = ['pdb100', 'afdb-swissprot', 'afdb50', 'afdb-proteome', 'mgnify_esm30', 'cath50', 'gmgcl_id']
         database = databases[db -1]
         print(f'Selected database {database}')
 
-        from time import sleep
-        import sys
         import tarfile
         import datetime
-        import pandas as pd
 
         # where to save the output
         if os.path.exists(out_dir):
@@ -212,148 +1619,142 @@ if request == 'foldseek':
         if get_all:
             confirm = ShowWin('Custom', 'Warning', 400, 170, 
                             'Text', 20, 48, "Downloading all homologs can take a long",
-                            'Text', 20, 78, "time and cause memory overload. Continue?",
+                            'Text', 20, 78, f"time, they're shown {PAGE_SIZE} at a time. Continue?",
                             'Button', 130, 120, "Yes",
                             'Button', 250, 120, "No")
             if confirm[0] == 'Yes':
                 n_get = 'all'
             else:
                 stop_plg('Aborted.', start_time=start_time)
+        # "All" is loaded in pages of PAGE_SIZE, see load_pdbs
+        pages = {'size': PAGE_SIZE, 'page': 0, 'count': 0, 'files': [], 'loaded': []} if n_get == 'all' else None
 
-        target = [selection[0].object[j].number.inyas for j in range(selection[0].objects)][0]
-        target_name = NameObj(target)[0]
-
-        # make output dirs if necessary
-        target_out_dir = os.path.join(outputdir, 'fs_web_hits', target_name)
-        dirs = [os.path.join(outputdir, 'fs_web_hits'), target_out_dir]
-        for dir in dirs:
-            if not os.path.exists(dir):
-                os.mkdir(dir)
+        targets = [selection[0].object[j].number.inyas for j in range(selection[0].objects)]
+        target_names = query_names(targets)
 
         # Get the current date and time
         datetime_str = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        report_file = os.path.join(outputdir, 'fs_web_hits', f'run_report_{datetime_str}.json')
+
+        # save all queries; cached searches of the same coordinates against the same database are reused,
+        # the others are sent to the web server in parallel
+        alns, jobs = {}, {}
+        for target, target_name in zip(targets, target_names):
+            # make output dirs if necessary
+            target_out_dir = os.path.join(outputdir, 'fs_web_hits', target_name)
+            os.makedirs(target_out_dir, exist_ok=True)
+
+            fquery = os.path.join(target_out_dir, target_name + '_' + datetime_str + '_fsquery.pdb')
+            # object coordinates, not scene ones, the frame FoldSeek's transforms of the hits refer to (see load_pdbs)
+            SavePDB(target, fquery, transform='No')
+
+            aln_prefix = os.path.join(target_out_dir, target_name + '_' + datetime_str + '_')
+            search_key = query_hash(fquery, 'online', database)
+            manifests[target] = open_manifest(os.path.join(target_out_dir, target_name + '_manifest.json'), search_key, resume,
+                                              query=fquery, database=database)
+            if resumed_alns(manifests[target]):
+                # the earlier run's result, however old
+                alns[target] = manifests[target]['alns'][0]
+                continue
+            cached = search_cache_get(search_key)
+            if cached and os.path.exists(cached['aln']):
+                print(f"Using cached FoldSeek result of ticket {cached['ticket']} from {datetime.datetime.fromtimestamp(cached['created'])} for obj {target}")
+                alns[target] = aln_prefix + cached['aln_name']
+                shutil.copyfile(cached['aln'], alns[target])
+                manifests[target].update(ticket=cached['ticket'], alns=[alns[target]])
+            else:
+                jobs[target] = (fquery, aln_prefix, search_key)
 
-        fquery = os.path.join(target_out_dir, target_name + '_' + datetime_str + '_fsquery.pdb')
-        SavePDB(target, fquery)
-
-        # submit a new job
-        ShowMessage('Submitting job to FoldSeek webserver.')
-        Wait(1)
-        with open(fquery, 'r') as pdb_file:
-            pdb_content = pdb_file.read()
-            ticket = post('https://search.foldseek.com/api/ticket', 
-                        files={'q': (pdb_content, pdb_content, 'application/octet-stream')},
-                        data={
-                            'mode' : '3diaa',
-                            'database[]' : databases,
-                        }).json()
-
-        # poll until the job was successful or failed
-        repeat = True
-        wait_time = time.perf_counter()
-        while repeat:
-            ShowMessage(f'Waiting for result from FoldSeek server ({round(time.perf_counter()  - wait_time,0)}s)')
+        if jobs:
+            ShowMessage(f'Submitting {len(jobs)} job{"s" if len(jobs) > 1 else ""} to FoldSeek webserver.')
             Wait(1)
-            status = get('https://search.foldseek.com/api/ticket/' + ticket['id']).json()
-            if status['status'] == "ERROR":
-                # handle error
-                sys.exit(0)
-
-            # wait a short time between poll requests
-            sleep(10)
-            repeat = status['status'] != "COMPLETE"
-        
-        ShowMessage(f'Receiving results ({round(time.perf_counter()  - wait_time,0)}s)')
-        Wait(1)
-        # get results in JSON format
-        result = get('https://search.foldseek.com/api/result/' + ticket['id'] + '/0').json()
-
-        # download result to file
-        download = get('https://search.foldseek.com/api/result/download/' + ticket['id'], stream=True)
-        web_out_file = os.path.join(target_out_dir, 'result.tar.gz')
-        
-        with open(web_out_file, 'wb') as fd:
-            for chunk in download.iter_content(chunk_size=128):
-                fd.write(chunk)
-
-        if os.path.exists(web_out_file):
-            file = tarfile.open(web_out_file)
-            file.extractall(target_out_dir)            
-            file.close()
-            out_files = [x for x in os.listdir(target_out_dir) if x.startswith('ali') and x.endswith('m8')]
-            for file in out_files:
-                os.rename(os.path.join(target_out_dir, file), os.path.join(target_out_dir, target_name + '_' + datetime_str + '_' + file))
-        else:
-            stop_plg(f"An error occured while running obj {target} the FoldSeek server.", start_time=start_time)
-
-        alns = os.path.join(target_out_dir, target_name + '_' + datetime_str + '_' + [x for x in out_files if database in x][0])
-
-        server_output_column_names = ["query","target","pident","alnlen","mismatch","gapopen","qstart","qend","tstart","tend","prob","evalue","bits","qlen","tlen","qaln","taln","tca","tseq","taxid","taxname"]
-        hits_df = pd.read_table(alns, header=None, names=server_output_column_names)
-
-        hits = hits_df['target'].tolist()
-        hits = list(set([x.split(' ')[0] for x in hits]))
-
-        if n_get != 'all':
-            hits = hits[:n_get]
-
-        ShowMessage(f'Getting {len(hits)} structures, please wait.')
-        Wait(1)
-
-        ### download pdbs
-        # write hit file
+            wait_time = time.perf_counter()
+            with phase('search'), ThreadPoolExecutor(max_workers=MAX_TICKETS) as pool:
+                futures = {pool.submit(run_ticket, fquery, databases, database, aln_prefix): target
+                           for target, (fquery, aln_prefix, search_key) in jobs.items()}
+                pending = set(futures)
+                while pending:
+                    ShowMessage(f'Waiting for result from FoldSeek server ({round(time.perf_counter()  - wait_time,0)}s, {len(pending)} of {len(jobs)} running)')
+                    Wait(1)
+                    done, pending = wait(pending, timeout=1)
+            for future, target in futures.items():
+                ticket_id, aln = future.result()
+                if aln is None:
+                    # with a single query there's nothing left to do, otherwise continue with the others
+                    if len(targets) == 1:
+                        stop_plg(f"The FoldSeek server reported an error for obj {target}.", start_time=start_time)
+                    print(f"The FoldSeek server reported an error for obj {target}, skipping it.")
+                    continue
+                alns[target] = aln
+                manifests[target].update(ticket=ticket_id, alns=[aln])
+                search_cache_put(jobs[target][2], aln, ticket=ticket_id, aln_name=aln[len(jobs[target][1]):])
+        if not alns:
+            stop_plg('The FoldSeek server reported an error for all objects.', start_time=start_time)
+
+        # where the hit structures are downloaded from, also used by the buttons
         if 'afdb' in database:
-            dlserver = 'https://alphafold.ebi.ac.uk/files'
-            hit_pdbs = hits
-            hit_mols = ['A' for x in range(len(hits))]
-        elif database == 'pdb100': 
-            dlserver = 'https://files.rcsb.org/view'
-            hit_pdbs = [x.split('_')[0] for x in hits]
-            hit_mols = [x.split('_')[1] for x in hits]
+            dlserver = AFDB_SERVER
+        elif database == 'pdb100':
+            dlserver = RCSB_SERVER
         elif database == 'mgnify_esm30':
-            dlserver = 'https://api.esmatlas.com/fetchPredictedStructure'
-            hit_pdbs = [x.split('.')[0] for x in hits]
-            hit_mols = ['A' for x in range(len(hits))]
-        
-        if not os.path.exists(f'{target_out_dir}/hits/'):
-            os.mkdir(f'{target_out_dir}/hits/')
-        
-        with open(os.path.join(target_out_dir, 'hits', target_name + '_' + datetime_str + '_' + 'hits'), 'w') as file:
-            file.write('\n')
-            for i in range(len(hit_pdbs)):
-                file.write(f" {hit_pdbs[i]}   {hit_mols[i]}\n")
-             
-        get_pdbs(hit_pdbs, dlserver=dlserver, dir=f'{target_out_dir}/hits/', target=target_name)
-        if dlserver == 'https://api.esmatlas.com/fetchPredictedStructure':
-            import fileinput
-            pattern = r'(^ATOM +[0-9]+)( *[A-Z0-9]+) (.*)'
-            replacement = r'\1 \2\3'
-            for i, hit in enumerate(hit_pdbs):
-                # Construct the full path to the file
-                file_path = os.path.join(os.path.join(target_out_dir, 'hits'), f'{i + 1}_{hit}.pdb')
-
-                # check if pbd file has a formatting issue
-                chk_pattern = '^ATOM + [0-9]+ +(?=[^ ] )'
-                chk_line = next((re.search(chk_pattern, line).group() for line in open(file_path) if re.search(chk_pattern, line)), None)
-                if len(''.join(reversed(chk_line)).lstrip()) - len(chk_line) < 0:
-                    print(f'Found formatting issue in file {file_path}; auto-correcting.')
-                    # Process the file in-place
-                    with fileinput.FileInput(file_path, inplace=True, backup='.bak') as file:
-                        for line in file:
-                            modified_line = re.sub(pattern, replacement, line)
-                            print(modified_line, end='')
-
-        load_pdbs(hit_pdbs, hit_mols, f'{target_out_dir}/hits/', del_homologs= del_homologs)
+            dlserver = ESM_SERVER
+
+        for target, target_name in zip(targets, target_names):
+            if target not in alns:
+                continue
+            target_out_dir = os.path.join(outputdir, 'fs_web_hits', target_name)
+            fquery = os.path.join(target_out_dir, target_name + '_' + datetime_str + '_fsquery.pdb')
+            # unique hits in the server's ranking, only the first n_get are read
+            with phase('parse hits'):
+                hits, rows = read_hits(alns[target], SERVER_COLUMNS, n_get)
+            if SAVE_TABLE:
+                save_table(alns[target], SERVER_COLUMNS)
+            if not hits:
+                if len(targets) == 1:
+                    stop_plg('No homologs were found!', start_time=start_time)
+                print(f'No homologs were found for obj {target}.')
+                continue
+
+            ShowMessage(f'Getting {len(hits)} structures for obj {target}, please wait.')
+            Wait(1)
+
+            ### download pdbs
+            # write hit file
+            if 'afdb' in database:
+                hit_pdbs = hits
+                hit_mols = ['A' for x in range(len(hits))]
+            elif database == 'pdb100': 
+                hit_pdbs = [x.split('_')[0] for x in hits]
+                hit_mols = [x.split('_')[1] for x in hits]
+            elif database == 'mgnify_esm30':
+                hit_pdbs = [x.split('.')[0] for x in hits]
+                hit_mols = ['A' for x in range(len(hits))]
+            
+            if not os.path.exists(f'{target_out_dir}/hits/'):
+                os.mkdir(f'{target_out_dir}/hits/')
+            
+            with open(os.path.join(target_out_dir, 'hits', target_name + '_' + datetime_str + '_' + 'hits'), 'w') as file:
+                file.write('\n')
+                for i in range(len(hit_pdbs)):
+                    file.write(f" {hit_pdbs[i]}   {hit_mols[i]}\n")
+            manifest_hits(manifests[target], hits, hit_pdbs, hit_mols, [dlserver] * len(hits), f'{target_out_dir}/hits/', del_homologs)
+                 
+            ready = start_pdbs(hit_pdbs, dlserver=dlserver, dir=f'{target_out_dir}/hits/', target=target_name,
+                               chains=hit_mols if del_homologs else None, manifest=manifests[target])
+            annotating.append(start_annotations(hit_pdbs, [dlserver] * len(hit_pdbs)))
+
+            transforms = web_transforms(rows.values(), hits, fquery)
+            load_pdbs(hit_pdbs, f'{target_out_dir}/hits/', target, ready=ready,
+                      transforms=[transforms.get(x) for x in hits], refine=refine,
+                      meta=[{'accession': hit_pdbs[i], 'query': target_name, 'target': hits[i], 'server': dlserver, 'columns': rows[hits[i]]}
+                            for i in range(len(hits))], pages=pages, manifest=manifests[target])
   
         ShowMessage('Done.')
 
     ### LOCAL / OFFLINE FOLDSEEEK
     else:
         print(f'python interpreter is: {sys.executable}')
-        required_modules = {'pandas': 'pandas', # Import name before colon, pip installation name after colon
-                            'requests': 'requests',
-                            'gzip': 'gzip',
-                            'Bio': 'Bio'} 
+        required_modules = {'requests': 'requests'} # Import name before colon, pip installation name after colon
         missing_modules = [module for module in required_modules if not check_and_install_module(module)]
         if missing_modules:
             install_choice =\
@@ -384,27 +1785,25 @@ if request == 'foldseek':
                 ShowMessage("Some python modules are missing, try installing manually. Exiting.")
                 plugin.end()
 
-        import pandas as pd
-        import gzip
-        from collections import OrderedDict
-        from Bio.PDB import MMCIFParser, PDBIO
-
-        button_click, db, del_homologs, n_get, get_all, out_dir, flags  =\
-            ShowWin("Custom", "Local FoldSeek Parameters", 600, 380,
+        button_click, db, del_homologs, n_get, get_all, refine, resume, out_dir, flags  =\
+            ShowWin("Custom", "Local FoldSeek Parameters", 600, 415,
                 "Text", 20, 48, "Choose database:",
-                "RadioButtons", 3, 1,
+                "RadioButtons", 4, 1,
                 20,68,"PDB",
                 20,103,"AlphaFold Swissprot",
                 20,138,'AlphaFold UniProt50 (slow)',
+                20,173,'PDB + AlphaFold Swissprot',
                 "CheckBox", 265, 48, "Delete non-homologous chains", True,
                 "NumberInput", 265, 90, "Number of structures to retrieve", 20, 1, 1000,
                 "CheckBox", 390, 107, "All", False,
-                "TextInput", 20, 190, "Output folder (current folder if empty)", 550, 100,
-                "TextInput", 20, 260, "Custom option flags (check manual)", 550, 100,
-                "Button", 350, 330, "Switch to Online FoldSeek",
-                "Button", 150, 330, "OK")
-
-        databases = ["PDB", "AF SwissProt", "AF Uniprot"]
+                "CheckBox", 265, 145, "Refine superposition with SHEBA", False,
+                "CheckBox", 265, 180, "Resume the last run of these objects", False,
+                "TextInput", 20, 225, "Output folder (current folder if empty)", 550, 100,
+                "TextInput", 20, 295, "Custom option flags (check manual)", 550, 100,
+                "Button", 350, 365, "Switch to Online FoldSeek",
+                "Button", 150, 365, "OK")
+
+        databases = ["PDB", "AF SwissProt", "AF Uniprot", "PDB + AF SwissProt"]
         if button_click != 'OK':
             with open(os.path.join(gettempdir(), 'fs_plg_runonline'), 'w') as file:
                 file.write('run_online')
@@ -412,22 +1811,48 @@ if request == 'foldseek':
 
         ### process user parameters
         # if installed version is >=6, a more memory effcient option is available
-        # if int(version[0]) >= 6:
-        if version[0] == 'b' or int(version[0]) >= 6:
+        if found['major'] >= 6:
             options = '--prefilter-mode 1 ' + flags
+            # also report FoldSeek's own superposition, so hits need no realignment
+            if '--format-output' not in flags:
+                options = f'--format-output {",".join(LOCAL_COLUMNS)} ' + options
         else:
             options = flags
 
-        # which database of foldseek to use and where is it? where can files be downloaded?
-        if db == 1:
-            fsdb = '/usr/local/bin/foldseek/pd'
-            dlserver = 'https://files.rcsb.org/view'
-        elif db == 2:
-            fsdb = '/usr/local/bin/foldseek/sp'
-            dlserver = 'https://alphafold.ebi.ac.uk/files'
-        elif db == 3:
-            fsdb = '/usr/local/bin/foldseek/up50'
-            dlserver = 'https://alphafold.ebi.ac.uk/files'
+        # columns of the alignment files: the requested ones, else foldseek's default (the first 12 of LOCAL_COLUMNS)
+        format_output = re.search(r'--format-output\s+(\S+)', options)
+        aln_columns = format_output.group(1).split(',') if format_output else LOCAL_COLUMNS[:12]
+
+        # which databases of foldseek to use and where are they? where can files be downloaded?
+        # the combined choice searches MERGED_DBS concurrently, each with its share of the cpu threads
+        search_dbs = []
+        for i in (MERGED_DBS if db == 4 else [db]):
+            fsdb = os.path.join(DB_DIR, DB_NAMES[i - 1])
+            if not os.path.exists(fsdb + '.dbtype'):
+                stop_plg(f'Error: FoldSeek database {fsdb} not found. Databases in {DB_DIR}: {", ".join(found["dbs"]) or "none"}')
+            search_dbs.append((fsdb, RCSB_SERVER if i == 1 else AFDB_SERVER, f'_{DB_NAMES[i - 1]}' if db == 4 else ''))
+        dlserver = RCSB_SERVER if any(server == RCSB_SERVER for fsdb, server, tag in search_dbs) else AFDB_SERVER
+
+        for fsdb, server, tag in search_dbs:
+            # without an index every run reads the whole database from disk again, offer to build it once
+            if not index_valid(fsdb):
+                build = ShowWin('Custom', 'Database index', 400, 200,
+                                'Text', 20, 48, f"{os.path.basename(fsdb)} ({db_size(fsdb) / 1e9:.1f} GB) has no up-to-date",
+                                'Text', 20, 78, "index. Build it now? This takes a while",
+                                'Text', 20, 108, "but makes every following search faster.",
+                                'Button', 130, 150, "Yes",
+                                'Button', 250, 150, "No")
+                if build[0] == 'Yes':
+                    ShowMessage(f'Building index for {fsdb}, please wait.')
+                    Wait(1)
+                    if not build_index(fs, fsdb):
+                        print(f'Building the index for {fsdb} failed, searching without it.')
+            print(f'Database {fsdb}: {db_size(fsdb) / 1e9:.1f} GB, ' +
+                  (f'index {db_size(fsdb, index=True) / 1e9:.1f} GB' if index_valid(fsdb) else 'no index'))
+        if '--db-load-mode' not in flags:
+            options += f' --db-load-mode {DB_LOAD_MODE}'
+        if len(search_dbs) > 1 and '--threads' not in flags:
+            options += f' --threads {max(1, (os.cpu_count() or 1) // len(search_dbs))}'
 
         # where to save the output
         if os.path.exists(out_dir):
@@ -442,16 +1867,19 @@ if request == 'foldseek':
         if get_all:
             confirm = ShowWin('Custom', 'Warning', 400, 170, 
                             'Text', 20, 48, "Downloading all homologs can take a long",
-                            'Text', 20, 78, "time and cause memory overload. Continue?",
+                            'Text', 20, 78, f"time, they're shown {PAGE_SIZE} at a time. Continue?",
                             'Button', 130, 120, "Yes",
                             'Button', 250, 120, "No")
             if confirm[0] == 'Yes':
                 n_get = 'all'
             else:
                 stop_plg('Aborted.')
+        # "All" is loaded in pages of PAGE_SIZE, see load_pdbs
+        pages = {'size': PAGE_SIZE, 'page': 0, 'count': 0, 'files': [], 'loaded': []} if n_get == 'all' else None
 
         ### Begin of actual script
         start_time = time.perf_counter()
+        report_file = os.path.join(outputdir, 'hits', f'run_report_{time.strftime("%Y%m%d%H%M%S")}.json')
 
         # make output dirs if necessary
         dirs = [outputdir + os.path.sep + 'tmp', outputdir + os.path.sep + 'q', outputdir + os.path.sep + 'alns', outputdir + os.path.sep + 'hits']
@@ -459,62 +1887,145 @@ if request == 'foldseek':
             if not os.path.exists(dir):
                 os.mkdir(dir)
 
-        target = [selection[0].object[j].number.inyas for j in range(selection[0].objects)][0]
-        target_name = NameObj(target)[0]
-
-        # create the query pdb and run foldseek
-        SavePDB(target, outputdir + os.path.sep + 'q' + os.path.sep + target_name + '_fsquery.pdb')
-        ShowMessage(f'Running FoldSeek on object {target}, please wait.')
-        fs_command = f'{fs} easy-search {outputdir}/q/{target_name}_fsquery.pdb {fsdb} {outputdir}/alns/{target_name}_aln {outputdir}/tmp --remove-tmp-files true {options}'
-        Print('Command:\n' + fs_command)
-        Wait(1)
-        noerr = subprocess.run(fs_command, 
-                    shell=True, capture_output=True, text=True)
-        for line in noerr.stdout.split('\n'):
-            print(line)
-
-        # ensure it has worked
-        if noerr.returncode > 0 or not os.path.exists(f'{outputdir}/alns/{target_name}_aln'):
-            stop_plg('Error: Something went wrong, check the console.', start_time=start_time)
-
-        # load hits from file, get unique pdbs and number of requested results
-        try:
-            hits = pd.read_table(f'{outputdir}/alns/{target_name}_aln', header=None)[1]
-        except pd.errors.EmptyDataError:
-            stop_plg('No homologs were found!', start_time=start_time)
-
-        # check if a header was present
-        if hits.iloc[0] == 'target':
-            hits = hits.iloc[1:].tolist()  # Discard the first row
-        else:
-            hits = hits.tolist()
-        
-        hits = list(OrderedDict.fromkeys(hits))
-        if n_get != 'all':
-            hits = hits[:n_get]
-
-        ShowMessage(f'Getting {len(hits)} structures, please wait.')
-        Wait(1)
-
-        ### download pdbs
-        # write hit file
-        if dlserver == 'https://files.rcsb.org/view':
-            hit_pdbs = [x.split('_')[0] for x in hits]
-            hit_mols = [x.split('_')[1] for x in hits]
-        elif dlserver == 'https://alphafold.ebi.ac.uk/files':
-            hit_pdbs = hits
-            hit_mols = ['A' for x in range(len(hits))]
-            
-        with open(f'{outputdir}/hits/{target_name}_hits', 'w') as file:
-            file.write('\n')
-            for i in range(len(hit_pdbs)):
-                file.write(f" {hit_pdbs[i]}   {hit_mols[i]}\n")
-             
-        get_pdbs(hit_pdbs, dlserver=dlserver, dir=f'{outputdir}/hits/', target=target_name)
-
-        load_pdbs(hit_pdbs, hit_mols, f'{outputdir}/hits/', del_homologs= del_homologs)
+        targets = [selection[0].object[j].number.inyas for j in range(selection[0].objects)]
+        target_names = query_names(targets)
+
+        # create the query pdbs
+        for target, target_name in zip(targets, target_names):
+            # object coordinates, not scene ones, the frame FoldSeek's transforms of the hits refer to (see load_pdbs)
+            SavePDB(target, outputdir + os.path.sep + 'q' + os.path.sep + target_name + '_fsquery.pdb', transform='No')
+
+        # queries resumed from their manifest get the search output of the earlier run back instead of a new search
+        for target_name in target_names:
+            manifests[target_name] = open_manifest(f'{outputdir}/hits/{target_name}_manifest.json',
+                                                   query_hash(f'{outputdir}/q/{target_name}_fsquery.pdb', 'local',
+                                                              *[fsdb for fsdb, server, tag in search_dbs], options),
+                                                   resume, databases=[fsdb for fsdb, server, tag in search_dbs], options=options)
+            if resumed_alns(manifests[target_name]):
+                for fsdb, server, tag in search_dbs:
+                    shutil.copyfile(f'{outputdir}/hits/{target_name}{tag}_manifest_aln', f'{outputdir}/alns/{target_name}{tag}_aln')
+        resumed = [target_name for target_name in target_names if resumed_alns(manifests[target_name])]
+
+        # search with a budget sized to n_get first; queries with too few unique hits are searched again
+        # with a larger one, and finally with foldseek's defaults. "All" always uses the defaults
+        pending = [(target_name, search_db) for target_name in target_names for search_db in search_dbs if target_name not in resumed]
+        for level in BUDGET_LEVELS + [None] if n_get != 'all' else [None]:
+            run_options = options + budget_flags(n_get, level, flags)
+
+            # reuse cached results of the same coordinates, database and options
+            queries = {}
+            for target_name, (fsdb, server, tag) in pending:
+                search_key = query_hash(f'{outputdir}/q/{target_name}_fsquery.pdb', 'local', fsdb, run_options)
+                cached = search_cache_get(search_key)
+                if cached and os.path.exists(cached['aln']):
+                    print(f"Using cached FoldSeek result from {time.ctime(cached['created'])} for obj {target_name} in {fsdb}")
+                    shutil.copyfile(cached['aln'], f'{outputdir}/alns/{target_name}{tag}_aln')
+                else:
+                    queries.setdefault((fsdb, server, tag), {})[target_name] = search_key
+
+            # and run foldseek on the rest, all databases at the same time
+            if queries:
+                ShowMessage(f'Running FoldSeek on {len(set(name for names in queries.values() for name in names))} object(s) in {len(queries)} database(s), please wait.')
+                Wait(1)
+                with phase('search'), ThreadPoolExecutor(max_workers=len(queries)) as pool:
+                    futures = [pool.submit(local_search, fs, list(names), fsdb, run_options, outputdir, tag)
+                               for (fsdb, server, tag), names in queries.items()]
+                if not all(future.result() for future in futures):
+                    stop_plg('Error: Something went wrong, check the console.', start_time=start_time)
+            for (fsdb, server, tag), names in queries.items():
+                for target_name, search_key in names.items():
+                    search_cache_put(search_key, f'{outputdir}/alns/{target_name}{tag}_aln', database=fsdb, options=run_options)
+
+            # nothing to enlarge if the search ran without a budget
+            if run_options == options:
+                break
+            pending = [(target_name, search_db) for target_name, search_db in pending
+                       if len(read_hits(f'{outputdir}/alns/{target_name}{search_db[2]}_aln', aln_columns, n_get)[0]) < n_get]
+            if not pending:
+                break
+            print(f'Fewer than {n_get} hits for {", ".join(sorted(set(name for name, search_db in pending)))}, searching again with a larger budget.')
+
+        # keep a copy of each search output with the manifest, the alns folder is shared by all runs
+        for target_name in target_names:
+            if target_name not in resumed:
+                for fsdb, server, tag in search_dbs:
+                    shutil.copyfile(f'{outputdir}/alns/{target_name}{tag}_aln', f'{outputdir}/hits/{target_name}{tag}_manifest_aln')
+                manifests[target_name]['alns'] = [f'{outputdir}/hits/{target_name}{tag}_manifest_aln' for fsdb, server, tag in search_dbs]
+
+        # the hits of several databases are ranked together into alns/<name>_aln
+        hit_servers = {}
+        if len(search_dbs) > 1:
+            for target_name in target_names:
+                hit_servers.update(merge_hits([(f'{outputdir}/alns/{target_name}{tag}_aln', server) for fsdb, server, tag in search_dbs],
+                                              aln_columns, n_get, f'{outputdir}/alns/{target_name}_aln'))
+
+        for target, target_name in zip(targets, target_names):
+            # with several queries, each gets its own hit directory
+            hit_dir = f'{outputdir}/hits/' if len(targets) == 1 else f'{outputdir}/hits/{target_name}/'
+            os.makedirs(hit_dir, exist_ok=True)
+
+            # load hits from file, get unique pdbs and number of requested results
+            with phase('parse hits'):
+                hits, rows = read_hits(f'{outputdir}/alns/{target_name}_aln', aln_columns, n_get)
+            if SAVE_TABLE:
+                save_table(f'{outputdir}/alns/{target_name}_aln', aln_columns)
+            if not hits:
+                if len(targets) == 1:
+                    stop_plg('No homologs were found!', start_time=start_time)
+                print(f'No homologs were found for obj {target}.')
+                continue
+
+            ShowMessage(f'Getting {len(hits)} structures for obj {target}, please wait.')
+            Wait(1)
 
-    ShowButtons(dlserver)
+            ### download pdbs
+            # write hit file; pdb hits are <id>_<chain>, AlphaFold ones have chain A
+            hit_dlservers = [hit_servers.get(x, dlserver) for x in hits]
+            hit_pdbs = [x.split('_')[0] if server == RCSB_SERVER else x for x, server in zip(hits, hit_dlservers)]
+            hit_mols = [x.split('_')[1] if server == RCSB_SERVER else 'A' for x, server in zip(hits, hit_dlservers)]
+                
+            with open(f'{hit_dir}{target_name}_hits', 'w') as file:
+                file.write('\n')
+                for i in range(len(hit_pdbs)):
+                    file.write(f" {hit_pdbs[i]}   {hit_mols[i]}\n")
+            manifest_hits(manifests[target_name], hits, hit_pdbs, hit_mols, hit_dlservers, hit_dir, del_homologs)
+                 
+            ready = start_pdbs(hit_pdbs, dlserver=hit_dlservers, dir=hit_dir, target=target_name,
+                               chains=hit_mols if del_homologs else None, manifest=manifests[target_name])
+            annotating.append(start_annotations(hit_pdbs, hit_dlservers))
+
+            transforms = local_transforms(rows.values(), hits)
+            load_pdbs(hit_pdbs, hit_dir, target, ready=ready,
+                      transforms=[transforms.get(x) for x in hits], refine=refine,
+                      meta=[{'accession': hit_pdbs[i], 'query': target_name, 'target': hits[i], 'server': hit_dlservers[i], 'columns': rows[hits[i]]}
+                            for i in range(len(hits))], pages=pages, manifest=manifests[target_name])
+
+    # give the annotation prefetch a moment to finish, so the buttons can answer offline
+    deadline = time.perf_counter() + ANNOTATION_WAIT
+    for thread in annotating:
+        thread.join(max(0, deadline - time.perf_counter()))
+
+    if PROFILE:
+        profiler.disable()
+        profiler.dump_stats(os.path.splitext(report_file)[0] + '.prof')
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+    write_report(report_file, start_time, databases=[databases[int(db) - 1]], n_get=n_get, objects=target_names,
+                 manifests=[manifest['path'] for manifest in manifests.values()])
+
+    # what is still missing can be picked up with "Resume" in the next run
+    for manifest in manifests.values():
+        save_manifest(manifest, force=True)
+        missing = [x['id'] for x in manifest['hits'] if 'downloaded' not in x['done']]
+        if missing:
+            print(f"{len(missing)} structures couldn't be downloaded ({', '.join(missing[:10])}{', ...' if len(missing) > 10 else ''}), "
+                  f"see {manifest['path']}. Run again with \"Resume\" to retry only these.")
+
+    # page buttons only for an "All" run with more than one page; an older run's pages are forgotten
+    if pages is not None:
+        save_pages(pages)
+    elif os.path.exists(PAGES_FILE):
+        os.remove(PAGES_FILE)
+    ShowButtons(dlserver, paged=pages is not None and len(pages['files']) > pages['size'])
     stop_plg('Finished.', start_time=start_time)
 
 elif request == 'Exit':
@@ -522,55 +2033,72 @@ elif request == 'Exit':
     Clear()
     LoadSce('ExitFoldSeek.sce')
 
-elif request == 'Showinfo':
+elif request in ('Nextpage', 'Previouspage'):
+    # swap the loaded page of an "All" run for the next or previous one, loaded from the aligned .yob files
+    try:
+        with open(PAGES_FILE) as file:
+            pages = json.load(file)
+    except (OSError, ValueError):
+        stop_plg('There are no paged FoldSeek results.', fs=False)
+    page = pages['page'] + (1 if request == 'Nextpage' else -1)
+    last_page = (len(pages['files']) - 1) // pages['size']
+    if page < 0 or page > last_page:
+        stop_plg(f"This is the {'first' if page < 0 else 'last'} page.", fs=False)
+
+    if pages['loaded']:
+        DelObj(' '.join(str(x) for x in pages['loaded']))
+    pages['loaded'] = []
+    for n, yob in enumerate(pages['files'][page * pages['size']:(page + 1) * pages['size']], 1):
+        if n % 10 == 1:
+            ShowMessage(f'Loading page {page + 1} / {last_page + 1}')
+            Wait(1)
+        if os.path.exists(yob):
+            pages['loaded'] += LoadYOb(yob)
+    pages['page'] = page
+    save_pages(dict(pages, files=list(enumerate(pages['files']))))
+    ShowMessage(f'Showing page {page + 1} / {last_page + 1}')
 
-    def find_matching_files(folder_path, input_strings):
-        matching_files = []
-        for file_name in os.listdir(folder_path):
-            for input_str in input_strings:
-                if file_name.startswith(input_str) and file_name.endswith('_aln'):
-                    matching_files.append(os.path.join(folder_path, file_name))
-        return matching_files
-    
-    aln_file = find_matching_files(f'{PWD()}/alns/', NameObj('ALL'))[0]
+elif request == 'Showinfo':
     target = ListObj(ShowWin('ObjectSelection', 'choose PDB')[0], format='OBJNAME')[0]
-    target = re.sub('^[0-9]+_', '', target)
-    vals = [line for line in open(f'{PWD()}/alns/5m10_aln') if target in line][0].split('\t')
-    cols = 'query,target,fident,alnlen,mismatch,gapopen,qstart,qend,tstart,tend,evalue,bits'.split(',')
-    
-    print(f"Info from {aln_file}:")
-    for token, value in zip(cols, vals):
-        print(f"{token.ljust(max(len(token) for token in cols))}: {value}")
+    hit = find_hit(target)
+    if hit is None:
+        stop_plg(f'No FoldSeek results are stored for {target}.', fs=False)
+
+    print(f"Info for {hit['object']} ({hit['target']}), hit of {hit['query']} from {hit['server']}, file {hit['path']}:")
+    width = max(len(token) for token in hit['columns'])
+    for token, value in hit['columns'].items():
+        print(f"{token.ljust(width)}: {value}")
+    annotation = cached_annotations([hit['accession']]).get(hit['accession'])
+    if annotation:
+        for token in ANNOTATION_FIELDS[1:-1]:
+            print(f"{token.ljust(width)}: {annotation[token]}")
 
 elif request == 'Openstructureentry':
     target = ListObj(ShowWin('ObjectSelection', 'choose PDB')[0], format='OBJNAME')[0]
-    target = re.sub('^[0-9]+_', '', target)
-    if re.search('^MG', target):
-        ShowURL(f'https://esmatlas.com/resources/detail/{target}')
-    elif re.search('^AF-', target):
-        ShowURL(f'https://www.rcsb.org/structure/{target}')
+    hit = find_hit(target)
+    accession = hit['accession'] if hit else re.sub('^[0-9]+_', '', target)
+    server = hit['server'] if hit else None
+    if server == ESM_SERVER or re.search('^MG', accession):
+        ShowURL(f'https://esmatlas.com/resources/detail/{accession}')
+    elif server == AFDB_SERVER or re.search('^AF-', accession):
+        ShowURL(f'https://alphafold.ebi.ac.uk/entry/{uniprot_accession(accession)}')
     else:
-        ShowURL(f'https://alphafold.ebi.ac.uk/entry/{target}')
+        ShowURL(f'https://www.rcsb.org/structure/{accession}')
 
 elif request == 'Openprimaryarticle':
     target = ListObj(ShowWin('ObjectSelection', 'choose PDB')[0], format='OBJNAME')[0]
-    target = re.sub('^[0-9]+_', '', target)
-    url = f'https://www.rcsb.org/structure/{target}'
-
-    response = get(url)
-
-    if response.status_code == 200:
-        doi = re.findall('https:\/\/doi\.org\/[\w\/.-]+', response.text)
-        doi = [x for x in list(set(doi)) if not x.endswith('pdb')]
-        print(f"found {len(doi)} article{'s' * (len(doi) != 1)} for this structures:")
-        for d in doi:
-            Print(d)
-        if len(doi) == 0:
-            stop_plg(f"Could not identify doi from this pdb site: {url}", fs=False)
-        else:
-            ShowURL(doi[0])
-    else:
-        stop_plg(f"Request failed with status code: {response.status_code}", fs=False)
-        plugin.end()
+    hit = find_hit(target)
+    if hit and hit['server'] != RCSB_SERVER:
+        stop_plg(f"{hit['accession']} is no PDB entry, so there is no primary article.", fs=False)
+    target = hit['accession'] if hit else re.sub('^[0-9]+_', '', target)
+
+    # annotations were usually prefetched with the hits, so this works offline too
+    annotation = cached_annotations([target]).get(target)
+    if annotation is None or not annotation['doi']:
+        annotation = {x['accession']: x for x in fetch_annotations([target], RCSB_SERVER)}.get(target, annotation)
+    if annotation is None or not annotation['doi']:
+        stop_plg(f"Could not find a primary article for {target}.", fs=False)
+    Print(f"Primary article of {target}: https://doi.org/{annotation['doi']}")
+    ShowURL(f"https://doi.org/{annotation['doi']}")
 
 plugin.end()
@@ -0,0 +1,82 @@
+# Synthetic inputs for the benchmarks: query and hit structures, FoldSeek web server alignments (.m8)
+# and their result archives. Everything is deterministic, so runs of the same size are comparable.
+import io
+import math
+import tarfile
+from functools import lru_cache
+
+BACKBONE = [(' N  ', 'N', -1.2), (' CA ', 'C', 0.0), (' C  ', 'C', 1.3), (' O  ', 'O', 1.9)]
+SERVER_DATABASES = {'pdb': 'pdb100', 'afdb': 'afdb50', 'esm': 'mgnify_esm30'}
+
+
+def helix(n):
+    # CA trace of an ideal alpha helix along z
+    return [(2.3 * math.cos(i * 1.745), 2.3 * math.sin(i * 1.745), 1.5 * i) for i in range(n)]
+
+
+def pdb_id(i):
+    # 1aaa, 2aab, ... unique for i < 17576
+    return f'{1 + i % 9}{chr(97 + i // 676 % 26)}{chr(97 + i // 26 % 26)}{chr(97 + i % 26)}'
+
+
+def hit_id(i, db):
+    if db == 'pdb':
+        return pdb_id(i)
+    if db == 'afdb':
+        return f'AF-Q{i:05d}-F1-model_v4'
+    return f'MGYP{i:012d}'
+
+
+def server_target(i, db):
+    # the target column of the web server: the entry (with chain for the PDB) and a description
+    if db == 'pdb':
+        return f'{pdb_id(i)}_A Synthetic protein {i}'
+    if db == 'afdb':
+        return f'{hit_id(i, db)} Synthetic protein {i}'
+    return f'{hit_id(i, db)}.pdb Synthetic protein {i}'
+
+
+@lru_cache(maxsize=None)
+def structure(residues, chains='A', shifted=False):
+    # a pdb file of helical backbones, one per chain, shifted 20 A apart. shifted writes the atom
+    # names one column to the left like some ESM Atlas files
+    lines = []
+    serial = 1
+    for c, chain in enumerate(chains):
+        for i, (x, y, z) in enumerate(helix(residues)):
+            for name, element, offset in BACKBONE:
+                if shifted:
+                    name = name.strip().ljust(4)
+                lines.append(f'ATOM  {serial:5d} {name} ALA {chain}{i + 1:4d}    '
+                             f'{x + offset + 20 * c:8.3f}{y:8.3f}{z:8.3f}  1.00 20.00           {element}')
+                serial += 1
+        lines.append(f'TER   {serial:5d}      ALA {chain}{residues:4d}')
+        serial += 1
+    lines.append('END')
+    return '\n'.join(lines) + '\n'
+
+
+def server_m8(hits, db, residues):
+    # FoldSeek web server alignment of a query with `residues` residues against `hits` targets, in rank order.
+    # every target is the query helix moved by 10 A in x, so the transforms of the plugin have real work to do
+    seq = 'A' * residues
+    tca = ','.join(f'{x + 10:.3f},{y:.3f},{z:.3f}' for x, y, z in helix(residues))
+    lines = []
+    for i in range(hits):
+        evalue = 1e-30 * 10 ** (i * 25 / max(hits, 1))
+        bits = 1000 - i * 900 / max(hits, 1)
+        lines.append('\t'.join(str(x) for x in [
+            'query_fsquery.pdb_A', server_target(i, db), 100.0, residues, 0, 0, 1, residues, 1, residues,
+            1.0, f'{evalue:.3g}', int(bits), residues, residues, seq, seq, tca, seq, 9606, 'Homo sapiens']))
+    return '\n'.join(lines) + '\n'
+
+
+def result_archive(hits, db, residues):
+    # the gzipped tar the web server returns for a ticket, with the alignment of one database
+    data = server_m8(hits, db, residues).encode()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        member = tarfile.TarInfo(f'alis_{SERVER_DATABASES[db]}.m8')
+        member.size = len(data)
+        archive.addfile(member, io.BytesIO(data))
+    return buffer.getvalue()
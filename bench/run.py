@@ -0,0 +1,129 @@
+# End-to-end benchmark of an online FoldSeek.py run against the local stand-ins in servers.py, with the stub
+# yasara module. Every size runs in a fresh process with its own output, cache and temp folders, so runs don't
+# share state unless --warm repeats one with the filled caches or --resume picks up its manifest.
+#
+#   python bench/run.py                          20, 200 and 1000 PDB hits
+#   python bench/run.py --hits 200 --db afdb --latency 0.05 --residues 400 --warm --json results.json
+import argparse
+import contextlib
+import glob
+import json
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN = os.path.join(os.path.dirname(BENCH_DIR), 'FoldSeek.py')
+# radio buttons of the online dialog (PDB, AlphaFold UniProt50, MGnify/ESM30) selecting the web server
+# databases pdb100, afdb50 and mgnify_esm30
+ONLINE_DB = {'pdb': 1, 'afdb': 3, 'esm': 5}
+
+
+def child(args):
+    # one plugin run in this process; prints the run report and the stub's call counts as JSON
+    sys.path.insert(0, BENCH_DIR)
+    import yasara
+    yasara.query_residues = args.residues
+    yasara.dialogs['Foldseek Webserver Parameters'] = [ONLINE_DB[args.db], True, args.child, False, args.refine, args.resume, args.out]
+    start = time.perf_counter()
+    with open(os.path.join(args.out, 'plugin.log'), 'a') as log, contextlib.redirect_stdout(log):
+        try:
+            runpy.run_path(PLUGIN, run_name='__main__')
+        except SystemExit:
+            pass
+    wall = time.perf_counter() - start
+    reports = sorted(glob.glob(os.path.join(args.out, 'fs_web_hits', 'run_report_*.json')), key=os.path.getmtime)
+    report = {}
+    if reports:
+        with open(reports[-1]) as file:
+            report = json.load(file)
+        report['downloads'].pop('files', None)
+    print(json.dumps({'wall': wall, 'report': report, 'calls': yasara.calls}))
+
+
+def run(args, hits, folder, base_url, resume=False):
+    # run the plugin for `hits` hits in a child process with the plugin's settings pointing at the stand-ins
+    import servers
+    temp = os.path.join(folder, 'temp')
+    out = os.path.join(folder, 'out')
+    os.makedirs(temp, exist_ok=True)
+    os.makedirs(out, exist_ok=True)
+    # force the online branch and skip looking for a local foldseek all over the filesystem
+    open(os.path.join(temp, 'fs_plg_runonline'), 'w').close()
+    with open(os.path.join(temp, 'fs_plg_discovery.json'), 'w') as file:
+        json.dump({'searched': time.time()}, file)
+
+    env = dict(os.environ, TMPDIR=temp, FS_PLG_CACHE_DIR=os.path.join(folder, 'cache'), FS_PLG_RSYNC_MIN=str(10 ** 9),
+               FS_PLG_PDB_MIRROR='', FS_PLG_AFDB_MIRROR='', **servers.env(base_url))
+    command = [sys.executable, os.path.abspath(__file__), '--child', str(hits), '--out', out, '--db', args.db,
+               '--residues', str(args.residues)] + (['--refine'] if args.refine else []) + (['--resume'] if resume else [])
+    start = time.perf_counter()
+    proc = subprocess.run(command, env=env, capture_output=True, text=True)
+    if proc.returncode != 0 or not proc.stdout.strip():
+        sys.exit(f'benchmark run failed:\n{proc.stderr}')
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['process_wall'] = time.perf_counter() - start
+    return result
+
+
+def summary(hits, label, result):
+    report = result['report']
+    total = report.get('total_seconds') or result['wall']
+    line = f"{hits:6d} {label:6s} {result['process_wall']:8.2f}s {total:8.2f}s {hits / total:8.1f} hits/s"
+    downloads = report.get('downloads', {})
+    if downloads.get('count'):
+        line += f"  {downloads['bytes'] / 1e6:7.1f} MB  p95 {downloads['p95_seconds']:.3f}s  {downloads['failed']} failed"
+    local = {source: n for source, n in downloads.get('sources', {}).items() if source != 'network'}
+    if local:
+        line += '  ' + ', '.join(f'{n} from {source}' for source, n in sorted(local.items()))
+    print(line)
+    for name, seconds in report.get('phases', {}).items():
+        throughput = f'{hits / seconds:10.1f} hits/s' if seconds >= 0.005 else f"{'-':>10s}"
+        print(f"{'':15s}{name.ljust(16)}{seconds:8.2f}s {throughput}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hits', type=int, nargs='+', default=[20, 200, 1000])
+    parser.add_argument('--db', choices=sorted(ONLINE_DB), default='pdb')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every request')
+    parser.add_argument('--search-seconds', type=float, default=1.0, help='time until a ticket is complete')
+    parser.add_argument('--residues', type=int, default=100, help='residues per chain of the query and the hits')
+    parser.add_argument('--chains', default='AB', help='chains of the PDB hit files')
+    parser.add_argument('--refine', action='store_true', help='also align every hit with SHEBA')
+    parser.add_argument('--warm', action='store_true', help='repeat each size with the caches of the first run')
+    parser.add_argument('--resume', action='store_true', help='repeat each size resuming the first run')
+    parser.add_argument('--json', help='write all results to this file')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        return child(args)
+
+    sys.path.insert(0, BENCH_DIR)
+    import servers
+    server, base_url = servers.start()
+    servers.config.update(latency=args.latency, search_seconds=args.search_seconds, residues=args.residues,
+                          chains=args.chains, db=args.db)
+    print(f"{'hits':>6s} {'run':6s} {'process':>9s} {'plugin':>9s} {'throughput':>15s}")
+    results = []
+    for hits in args.hits:
+        servers.config['hits'] = hits
+        with tempfile.TemporaryDirectory() as folder:
+            for label in ['cold'] + ['warm'] * args.warm + ['resume'] * args.resume:
+                servers.stats.update(requests=0, bytes=0)
+                result = run(args, hits, folder, base_url, resume=label == 'resume')
+                result.update(hits=hits, run=label, served=dict(servers.stats))
+                summary(hits, label, result)
+                results.append(result)
+    server.shutdown()
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'settings': vars(args), 'results': results}, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# Local HTTP stand-ins for the services FoldSeek.py talks to, all on one port under their own prefix:
+#   /foldseek   ticket / result API of the FoldSeek web server
+#   /rcsb /afdb /esm   structure files of RCSB, AlphaFold DB and ESM Atlas (pdb only, cif is 404)
+#   /graphql /afdb-api  annotation APIs of RCSB and AlphaFold DB
+# config is shared with the runner and may be changed between runs. every request waits config['latency']
+# seconds first, a search takes config['search_seconds'].
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fixtures
+
+config = {'latency': 0.0, 'search_seconds': 1.0, 'residues': 100, 'chains': 'AB', 'hits': 20, 'db': 'pdb'}
+stats = {'requests': 0, 'bytes': 0}
+_tickets = {}
+_ticket_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+def env(base_url):
+    # the plugin's settings pointing at a server started with start()
+    return {'FS_PLG_FOLDSEEK_SERVER': f'{base_url}/foldseek',
+            'FS_PLG_RCSB_SERVER': f'{base_url}/rcsb',
+            'FS_PLG_AFDB_SERVER': f'{base_url}/afdb',
+            'FS_PLG_ESM_SERVER': f'{base_url}/esm',
+            'FS_PLG_RCSB_GRAPHQL': f'{base_url}/graphql',
+            'FS_PLG_AFDB_API': f'{base_url}/afdb-api'}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200, content_type='application/octet-stream'):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with _lock:
+            stats['requests'] += 1
+            stats['bytes'] += len(body)
+
+    def do_POST(self):
+        time.sleep(config['latency'])
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/foldseek/api/ticket':
+            ticket = f'ticket-{next(_ticket_ids)}'
+            _tickets[ticket] = time.time()
+            self.reply(json.dumps({'id': ticket, 'status': 'PENDING'}), content_type='application/json')
+        elif self.path == '/graphql':
+            ids = json.loads(body)['variables']['ids']
+            entries = [{'rcsb_id': x, 'struct': {'title': f'Synthetic protein {x}'},
+                        'rcsb_primary_citation': {'pdbx_database_id_DOI': f'10.0000/{x.lower()}'},
+                        'rcsb_entry_info': {'resolution_combined': [2.0]},
+                        'polymer_entities': [{'rcsb_entity_source_organism': [{'scientific_name': 'Homo sapiens'}]}]} for x in ids]
+            self.reply(json.dumps({'data': {'entries': entries}}), content_type='application/json')
+        else:
+            self.reply('not found', 404)
+
+    def do_GET(self):
+        time.sleep(config['latency'])
+        ticket = re.match(r'^/foldseek/api/(ticket|result/download)/(.+)$', self.path)
+        structure = re.match(r'^/(rcsb|afdb|esm)/(.+)\.(pdb|cif)$', self.path)
+        if ticket and ticket.group(2) in _tickets:
+            if ticket.group(1) == 'ticket':
+                done = time.time() - _tickets[ticket.group(2)] >= config['search_seconds']
+                self.reply(json.dumps({'id': ticket.group(2), 'status': 'COMPLETE' if done else 'RUNNING'}), content_type='application/json')
+            else:
+                self.reply(fixtures.result_archive(config['hits'], config['db'], config['residues']))
+        elif structure and structure.group(3) == 'pdb':
+            chains = config['chains'] if structure.group(1) == 'rcsb' else 'A'
+            self.reply(fixtures.structure(config['residues'], chains, shifted=structure.group(1) == 'esm'))
+        elif self.path.startswith('/afdb-api/'):
+            accession = self.path.rsplit('/', 1)[1]
+            self.reply(json.dumps([{'uniprotDescription': f'Synthetic protein {accession}', 'organismScientificName': 'Homo sapiens'}]),
+                       content_type='application/json')
+        else:
+            self.reply('not found', 404)
+
+
+def start(port=0):
+    # serve in a daemon thread; returns the server and its base url
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
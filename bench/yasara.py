@@ -0,0 +1,89 @@
+# Stand-in for YASARA's python module, so FoldSeek.py runs outside YASARA for benchmarks.
+# Every call is counted in calls; ShowWin answers from dialogs (title -> values), set by the runner,
+# and objects are numbered as they are loaded. plugin.end() raises SystemExit like the end of a plugin.
+import os
+from types import SimpleNamespace
+
+import fixtures
+
+calls = {}
+dialogs = {}
+names = {1: 'query'}
+query_residues = 100
+request = 'foldseek'
+selection = [SimpleNamespace(objects=1, object=[SimpleNamespace(number=SimpleNamespace(inyas=1))])]
+
+
+def _end():
+    raise SystemExit(0)
+
+
+plugin = SimpleNamespace(end=_end)
+
+
+def _count(name):
+    calls[name] = calls.get(name, 0) + 1
+
+
+def ShowWin(kind, title='', *args):
+    _count('ShowWin')
+    return dialogs[title]
+
+
+def SavePDB(obj, filename, format=None, transform=None):
+    _count('SavePDB')
+    with open(filename, 'w') as file:
+        file.write(fixtures.structure(query_residues))
+
+
+def LoadPDB(filename, center=None, correct=None, model=None, download=None):
+    _count('LoadPDB')
+    number = max(names) + 1
+    names[number] = os.path.splitext(os.path.basename(filename))[0]
+    return [number]
+
+
+def LoadYOb(filename):
+    _count('LoadYOb')
+    return LoadPDB(filename)
+
+
+def SaveYOb(obj, filename):
+    _count('SaveYOb')
+    open(filename, 'w').close()
+
+
+def NameObj(obj, name=None):
+    _count('NameObj')
+    return [names.get(obj, str(obj))]
+
+
+def PosObj(obj, *position):
+    _count('PosObj')
+    return [0.0, 0.0, 0.0]
+
+
+def OriObj(obj, *orientation):
+    _count('OriObj')
+    return [0.0, 0.0, 0.0]
+
+
+def PWD():
+    _count('PWD')
+    return os.getcwd()
+
+
+def _recorder(name):
+    def call(*args, **kwargs):
+        _count(name)
+    return call
+
+
+for _name in ['CountObj', 'Console', 'ShowMessage', 'HideMessage', 'Wait', 'Print', 'PrintCon', 'DelObj', 'HideObj', 'AlignObj',
+              'ListObj', 'MakeImage', 'ShowImage', 'PrintImage', 'Font', 'ShowButton', 'ShowURL', 'SaveSce', 'LoadSce', 'Clear']:
+    globals()[_name] = _recorder(_name)
+
+__all__ = ['request', 'selection', 'plugin', 'ShowWin', 'SavePDB', 'LoadPDB', 'LoadYOb', 'SaveYOb', 'NameObj', 'PosObj',
+           'OriObj', 'PWD', 'Console', 'ShowMessage', 'HideMessage', 'Wait', 'Print', 'PrintCon', 'DelObj', 'HideObj',
+           'AlignObj', 'ListObj', 'MakeImage', 'ShowImage', 'PrintImage', 'Font', 'ShowButton', 'ShowURL', 'SaveSce',
+           'LoadSce', 'Clear', 'CountObj']